@@ -4,6 +4,7 @@
 
 ADDRESS=localhost
 PORT=27080
+PIDFILE=/tmp/sleepy.mongoose.${PORT}.pid
 
 ##################
 
@@ -16,6 +17,12 @@ python="`which python`"
 dir="$(cd `dirname "$0"` && pwd)"
 server="$dir/httpd.py"
 
+# The server runs in its own process group (with its pre-forked workers),
+# the group id is the pid of the master process stored in the pid file
+running() {
+    [ -f "${PIDFILE}" ] && kill -0 -- -"$(cat "${PIDFILE}")" 2>/dev/null
+}
+
 
 # Process action
 case ${action} in
@@ -27,14 +34,14 @@ case ${action} in
 
     start)
         # Check if running
-        pgrep -f "${server}" >/dev/null
-        if [ $? -eq 0 ]; then
+        if running; then
             echo "The server is already running.";
             exit 1;
         fi
 
-        # Run it in background
-        "${python}" "${server}" $@ &>/dev/null &
+        # Run it in background, in a new process group
+        setsid "${python}" "${server}" $@ &>/dev/null &
+        echo $! > "${PIDFILE}"
 
         # Check if the server is running (max 10s to wait)
         for i in 1 2 3 4 5; do
@@ -46,21 +53,23 @@ case ${action} in
                 exit 0;
             fi
         done
-        killall ${server}
+        kill -- -"$(cat "${PIDFILE}")" 2>/dev/null
+        rm -f "${PIDFILE}"
         echo "The server has not started!"
         exit 1;
         ;;
 
     stop)
         # Check if running
-        pgrep -f "${server}" >/dev/null
-        if [ $? -ne 0 ]; then
+        if ! running; then
             echo "The server is not running.";
+            rm -f "${PIDFILE}"
             exit 1;
         fi
-        pkill -SIGINT -f "${server}" >/dev/null
+        pgid="$(cat "${PIDFILE}")"
+        kill -SIGINT -- -"${pgid}" 2>/dev/null
 
-        pgrep -f "${server}" >/dev/null
+        running
         res=$?
 
         if [ ${res} -eq 0 ]; then
@@ -69,23 +78,25 @@ case ${action} in
                 echo -n -e "\b$i"
                 sleep 1
                 # If it is still running
-                pgrep -f "${server}" >/dev/null
+                running
                 res=$?
                 if [ ${res} -ne 0 ]; then break; fi
             done
 
             if [ ${res} -eq 0 ]; then
                 echo -e "\b Force kill server..."
-                pkill -f "${server}" >/dev/null
+                kill -SIGKILL -- -"${pgid}" 2>/dev/null
+                sleep 1
             else
                 echo -e "\b\bOK"
             fi
         fi
 
-        pgrep -f "${server}" >/dev/null
+        running
         res=$?
 
         if [ ${res} -ne 0 ]; then
+            rm -f "${PIDFILE}"
             echo "The server stopped successfully."
         else
             echo "Some errors occured while stopping the server! Exit code: $res";
@@ -0,0 +1,676 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from handlers import MongoHandler
+from pool import WorkerPool
+import codec
+import compression
+import metrics
+
+import asynchat
+import asyncore
+import cgi
+import collections
+import mimetools
+import os
+import socket
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+import Queue
+
+from cStringIO import StringIO
+from email.utils import formatdate
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """
+    Wakes up the event loop to run callbacks queued from worker threads
+    """
+
+    def __init__(self):
+        r, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r)
+        os.close(r)
+
+        self.lock = threading.Lock()
+        self.thunks = []
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_connect(self):
+        pass
+
+    def pull(self, thunk):
+        """
+        run thunk on the event loop thread, can be called from any thread
+        """
+        with self.lock:
+            self.thunks.append(thunk)
+        os.write(self.wfd, 'x')
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except socket.error:
+            pass
+
+        with self.lock:
+            thunks, self.thunks = self.thunks, []
+
+        for thunk in thunks:
+            thunk()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.wfd)
+
+
+class _ChunkedOut:
+    """
+    The output of a streamed response, written by the handler on a worker
+    thread and sent by the event loop in chunks
+    """
+
+    def __init__(self, channel, chunked, compressor=None):
+        self.channel = channel
+        self.chunked = chunked
+        self.compressor = compressor
+
+        self.buffer = []
+        self.size = 0
+        self.bytes = 0
+
+    def __call__(self, data):
+        if self.compressor is not None and data:
+            data = self.compressor.compress(data)
+        if not data:
+            return
+
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.channel.stream_chunk_size:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if not data:
+            return
+
+        self.bytes += len(data)
+        if self.chunked:
+            data = "%x\r\n%s\r\n" % (len(data), data)
+        self.channel.send_stream(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.buffer.append(self.compressor.flush())
+            self.compressor = None
+        self.flush()
+        if self.chunked:
+            self.channel.send_stream("0\r\n\r\n")
+
+
+class _FileProducer:
+    """
+    length bytes of a file from start, read as the event loop sends them
+    """
+
+    def __init__(self, channel, path, start, length, block_size):
+        self.channel = channel
+        self.path = path
+        self.start = start
+        self.length = length
+        self.remaining = length
+        self.block_size = block_size
+        self.fh = None
+
+    def __len__(self):
+        return self.length
+
+    def more(self):
+        if self.remaining <= 0:
+            return ""
+
+        if self.fh is None:
+            self.fh = open(self.path, 'rb')
+            self.fh.seek(self.start)
+
+        data = self.fh.read(min(self.block_size, self.remaining))
+        self.remaining -= len(data)
+        if self.remaining <= 0 or not data:
+            self.fh.close()
+        if not data:
+            # The file shrank since it was looked up, closing tells the client
+            self.remaining = 0
+            self.channel.close()
+        return data
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    """
+    One client connection. Requests are read without blocking, and only the
+    Mongo operations themselves are handed over to the worker pool, so an
+    idle keep-alive connection doesn't hold a thread.
+    """
+    max_header_size = 65536
+    # Request bodies are buffered, larger ones are refused
+    max_body_size = 67108864
+
+    # Bytes handed to the socket at once
+    ac_out_buffer_size = 65536
+
+    # Streamed responses are sent in chunks of stream_chunk_size bytes, the
+    # handler waits while more than stream_max_unsent bytes aren't sent yet
+    stream_chunk_size = 65536
+    stream_max_unsent = 1048576
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.addr = addr
+
+        self.ibuffer = []
+        self.request = None
+        self.pending = collections.deque()
+        self.busy = False
+        self.closing = False
+        self.requests = 0
+        self.args = None
+        self.last_activity = time.time()
+        self.set_terminator("\r\n\r\n")
+
+        # Bytes of the streamed response waiting for the event loop, and
+        # waiting in the output buffer
+        self.stream_cond = threading.Condition()
+        self.queued = 0
+        self.unsent = 0
+
+    def readable(self):
+        return not self.closing and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self.ibuffer.append(data)
+        if self.request is None and sum(len(d) for d in self.ibuffer) > self.max_header_size:
+            self.respond(413, "Request Entity Too Large", '{"ok": 0, "err": "request header is too large"}', False)
+
+    def found_terminator(self):
+        data = "".join(self.ibuffer)
+        self.ibuffer = []
+
+        if self.request is None:
+            request = self.parse_request(data)
+            if request is None:
+                return
+
+            if request[2].get('transfer-encoding', "identity").lower() != "identity":
+                # Only Content-Length framing, the chunks would be taken for the next request
+                self.respond(411, "Length Required",
+                             '{"ok": 0, "err": "chunked request bodies aren\'t supported, send a Content-Length"}',
+                             False)
+                return
+
+            try:
+                length = int(request[2].get('content-length', 0) or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.respond(400, "Bad Request", '{"ok": 0, "err": "invalid Content-Length"}', False)
+                return
+            if length > self.max_body_size:
+                self.respond(413, "Request Entity Too Large", '{"ok": 0, "err": "request body is too large"}', False)
+                return
+
+            if length > 0:
+                self.request = request
+                self.set_terminator(length)
+                return
+            self.enqueue(request, "")
+        else:
+            request, self.request = self.request, None
+            self.set_terminator("\r\n\r\n")
+            self.enqueue(request, data)
+
+    def parse_request(self, data):
+        lines = data.lstrip("\r\n").split("\r\n", 1)
+        words = lines[0].split()
+        if len(words) != 3 or words[0] not in ("GET", "POST"):
+            self.respond(400, "Bad Request", '{"ok": 0, "err": "bad request"}', False)
+            return None
+
+        method, path, version = words
+        headers = mimetools.Message(StringIO(lines[1] if len(lines) > 1 else ""))
+
+        connection = headers.get('connection', "").lower()
+        if version >= "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        self.requests += 1
+        max_requests = self.server.RequestHandlerClass.max_requests
+        if self.server.RequestHandlerClass.keepalive_timeout <= 0 or 0 < max_requests <= self.requests:
+            keep_alive = False
+
+        return method, path, headers, keep_alive, version
+
+    def enqueue(self, request, body):
+        # Pipelined requests are answered one by one, in order
+        self.pending.append((request, body))
+        if not self.busy:
+            self.next_request()
+
+    def next_request(self):
+        if not self.pending or not self.connected:
+            return
+
+        self.busy = True
+        request, body = self.pending.popleft()
+
+        if self.server.pool is None:
+            self.execute(request, body)
+            return
+
+        try:
+            self.server.pool.submit(self.execute, request, body)
+        except Queue.Full:
+            self.respond(503, "Service Unavailable", '{"ok": 0, "err": "server is busy"}', request[3],
+                         version=request[4])
+
+    def execute(self, request, body):
+        """
+        run the mongo handler, called on a worker thread if there is a pool
+        """
+        method, path, headers, keep_alive, version = request
+        request_class = self.server.RequestHandlerClass
+
+        start = metrics.registry.begin(len(body))
+        self.args = None
+        self.labels = ("unknown", None, None)
+        try:
+            response = self.call_handler(method, path, headers, body)
+        except Exception:
+            traceback.print_exc()
+            response = (500, "Internal Server Error", '{"ok": 0, "err": "internal server error"}')
+
+        labels = self.labels
+        code, message, content = response[:3]
+        content_type = response[3] if len(response) > 3 else request_class.mimetypes['json']
+        # Files of the docroot come with their own headers, and are already encoded
+        extra_headers = response[5] if len(response) > 5 else ()
+
+        if content is None:
+            # Streamed, only on a worker thread
+            (keep_alive, sent) = self.stream(response[4], keep_alive, version, content_type, headers)
+        elif len(response) > 6:
+            coding = response[6]
+            sent = len(content)
+        else:
+            # Compressed here rather than on the event loop
+            coding = None
+            if request_class.compress_level > 0 and compression.compressible(content_type) and \
+                    len(content) >= request_class.compress_min_size:
+                coding = compression.negotiate(headers.get('accept-encoding'))
+            if coding is not None:
+                content = compression.compress(content, coding, request_class.compress_level)
+            sent = len(content)
+
+        (elapsed, phases) = metrics.registry.end(start, labels[0], labels[1], labels[2], code, sent)
+        if request_class.slow_log is not None:
+            request_class.slow_log.log(elapsed, labels[0], labels[1], labels[2], code, phases, self.args)
+
+        if content is None:
+            self.server.trigger.pull(lambda: self.finish(keep_alive))
+        elif self.server.pool is None:
+            self.respond(code, message, content, keep_alive, content_type, coding, version, extra_headers)
+        else:
+            self.server.trigger.pull(lambda: self.respond(code, message, content, keep_alive, content_type, coding,
+                                                          version, extra_headers))
+
+    def stream(self, run, keep_alive, version, content_type, headers):
+        """
+        send the output of run(out) as it is written, in chunks (close delimited
+        for HTTP/1.0), returns whether the connection can be kept and the bytes sent
+        """
+        request_class = self.server.RequestHandlerClass
+
+        chunked = version >= "HTTP/1.1"
+        if not chunked:
+            keep_alive = False
+
+        # Streamed responses are always compressed, their size isn't known
+        coding = None
+        compressor = None
+        if request_class.compress_level > 0 and compression.compressible(content_type):
+            coding = compression.negotiate(headers.get('accept-encoding'))
+        if coding is not None:
+            compressor = compression.compressor(coding, request_class.compress_level)
+
+        out = _ChunkedOut(self, chunked, compressor)
+        try:
+            self.send_stream(self.head(200, "OK", content_type, keep_alive, coding=coding, chunked=chunked,
+                                       version=version))
+            run(out)
+            out.close()
+        except socket.error:
+            # The client went away
+            keep_alive = False
+        except Exception:
+            traceback.print_exc()
+            # The response is cut short, closing tells the client
+            keep_alive = False
+        return keep_alive, out.bytes
+
+    def send_stream(self, data):
+        """
+        queue data of a streamed response, waits while too much of it isn't sent yet
+        """
+        with self.stream_cond:
+            while self.connected and not self.closing and self.queued + self.unsent > self.stream_max_unsent:
+                self.stream_cond.wait(1)
+            if not self.connected or self.closing:
+                raise socket.error("the client closed the connection")
+            self.queued += len(data)
+
+        self.server.trigger.pull(lambda: self.push_stream(data))
+
+    def push_stream(self, data):
+        with self.stream_cond:
+            self.queued -= len(data)
+        if self.connected and not self.closing:
+            self.push(data)
+        self.update_unsent()
+
+    def handle_write(self):
+        asynchat.async_chat.handle_write(self)
+        # A client reading a large response slowly isn't idle
+        self.last_activity = time.time()
+        self.update_unsent()
+
+    def update_unsent(self):
+        with self.stream_cond:
+            self.unsent = sum(len(data) for data in self.producer_fifo if isinstance(data, str))
+            self.stream_cond.notify_all()
+
+    def call_handler(self, method, path, headers, body):
+        request_class = self.server.RequestHandlerClass
+
+        (uri, q, query) = path.partition('?')
+        if len(query):
+            args = dict(urlparse.parse_qsl(query))
+        else:
+            args = {}
+
+        content_type = headers.get('content-type', "").split(';')[0].strip().lower()
+        if method == "POST" and content_type in request_class.stream_types:
+            # The body is already buffered, it's read from memory
+            args['_body'] = StringIO(body)
+        elif method == "POST" and content_type == request_class.mimetypes['json']:
+            try:
+                pargs = codec.loads(body) if body.strip() else {}
+            except (ValueError, TypeError):
+                pargs = None
+            if not isinstance(pargs, dict):
+                return 200, "OK", '{"ok": 0, "err": "the request body must be a JSON object"}'
+            args.update(pargs)
+        elif method == "POST" and 'content-type' in headers:
+            pargs = cgi.FieldStorage(fp=StringIO(body),
+                                     environ={'REQUEST_METHOD': 'POST',
+                                              'CONTENT_TYPE': headers['content-type'],
+                                              'CONTENT_LENGTH': str(len(body))})
+            for k in pargs.keys():
+                args[k] = pargs.getvalue(k)
+
+        self.args = args
+
+        uri = uri.strip('/')
+        # default "/" to "/index.html"
+        if len(uri) == 0:
+            uri = "index.html"
+
+        (temp, dot, t) = uri.rpartition('.')
+        # if we have a collection name with a dot, don't use that dot for type
+        if len(dot) != 0 and uri.find('/') == -1:
+            self.labels = ("static", None, None)
+            if t not in request_class.mimetypes:
+                return 404, "Not Found", '{"ok": 0, "err": "File Not Found: %s"}' % uri.replace('"', '\\"')
+            return self.file_response(uri, request_class.mimetypes[t], headers)
+
+        (db, collection, func_name) = request_class._parse_call(uri)
+
+        func = None
+        if db is not None and func_name is not None:
+            func = getattr(MongoHandler.mh, func_name, None)
+        if not callable(func):
+            return 404, "Not Found", '{"ok": 0, "err": "Script Not Found: %s"}' % uri.replace('"', '\\"')
+        self.labels = (func_name, db, collection)
+
+        if func_name in MongoHandler.bson_handlers and 'format' not in args and \
+                MongoHandler.bson_type in headers.get('accept', ""):
+            args['format'] = "bson"
+
+        (content_type, stream) = MongoHandler.mh.response_type(func_name, args)
+        callback = None
+        if content_type is None:
+            content_type = request_class.mimetypes['json']
+            callback = args.get("callback")
+
+        if stream and self.server.pool is not None:
+            # Sent as it is written by execute()
+            def run(out):
+                if callback:
+                    out('%s(' % callback)
+                func(args, out, name=args.get("name"), db=db, collection=collection)
+                if callback:
+                    out(')')
+            return 200, "OK", None, content_type, run
+
+        if func_name == "_export":
+            # Without worker threads it would run on the event loop, and be buffered whole
+            return 200, "OK", '{"ok": 0, "err": "_export needs worker threads (-t) with the async engine"}'
+
+        # Other streamed output is one batch, it is buffered
+        output = []
+        func(args, output.append, name=args.get("name"), db=db, collection=collection)
+        output = "".join(output)
+
+        if callback:
+            output = '%s(' % callback + output + ')'
+
+        return 200, "OK", output, content_type
+
+    def file_response(self, uri, content_type, headers):
+        """
+        the response of a file of the docroot, answering conditional and range
+        requests like MongoHTTPRequest.send_file
+        """
+        request_class = self.server.RequestHandlerClass
+
+        f = request_class.static_files.lookup(urllib.unquote(uri))
+        if f is None:
+            return 404, "Not Found", '{"ok": 0, "err": "File Not Found: %s"}' % uri.replace('"', '\\"')
+
+        extra_headers = [('ETag', f.etag), ('Last-Modified', f.last_modified), ('Accept-Ranges', 'bytes')]
+
+        if f.not_modified(headers):
+            return 304, "Not Modified", "", content_type, None, extra_headers, None
+
+        byte_range = f.byte_range(headers)
+        if byte_range is False:
+            extra_headers.append(('Content-Range', 'bytes */%d' % f.size))
+            return 416, "Requested Range Not Satisfiable", "", content_type, None, extra_headers, None
+
+        if byte_range is not None:
+            (start, end) = byte_range
+            extra_headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, f.size)))
+            if f.content is not None:
+                content = f.content[start:end + 1]
+            else:
+                content = _FileProducer(self, f.path, start, end - start + 1, request_class.static_block_size)
+            return 206, "Partial Content", content, content_type, None, extra_headers, None
+
+        if f.content is None:
+            # Large files are sent as they are, read as they are sent
+            content = _FileProducer(self, f.path, 0, f.size, request_class.static_block_size)
+            return 200, "OK", content, content_type, None, extra_headers, None
+
+        coding = None
+        if request_class.compress_level > 0 and compression.compressible(content_type) and \
+                f.size >= request_class.compress_min_size:
+            coding = compression.negotiate(headers.get('accept-encoding'))
+
+        content = f.content
+        if coding is not None:
+            # Each coding is a different representation
+            extra_headers[0] = ('ETag', f.etag[:-1] + '-' + coding + '"')
+            content = f.encoded.get(coding)
+            if content is None:
+                content = f.encoded[coding] = compression.compress(f.content, coding, request_class.compress_level)
+        return 200, "OK", content, content_type, None, extra_headers, coding
+
+    def head(self, code, message, content_type, keep_alive, length=None, coding=None, chunked=False,
+             version="HTTP/1.1", headers=()):
+        """
+        the status line and headers of a response
+        """
+        request_class = self.server.RequestHandlerClass
+
+        lines = ["HTTP/1.1 %d %s" % (code, message),
+                 "Server: sleepy.mongoose",
+                 "Date: %s" % formatdate(usegmt=True),
+                 "Content-Type: %s" % content_type]
+        if length is not None:
+            lines.append("Content-Length: %d" % length)
+        if chunked:
+            lines.append("Transfer-Encoding: chunked")
+        if coding is not None:
+            lines.append("Content-Encoding: %s" % coding)
+        if request_class.compress_level > 0 and compression.compressible(content_type):
+            lines.append("Vary: Accept-Encoding")
+        for header in headers:
+            lines.append("%s: %s" % header)
+        for header in request_class.response_headers:
+            lines.append("%s: %s" % header)
+        if not keep_alive:
+            lines.append("Connection: close")
+        elif version < "HTTP/1.1":
+            # HTTP/1.0 connections are closed unless the response says otherwise
+            lines.append("Connection: keep-alive")
+
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def respond(self, code, message, body, keep_alive, content_type=None, coding=None, version="HTTP/1.1",
+                headers=()):
+        if self.closing or not self.connected:
+            return
+
+        if content_type is None:
+            content_type = self.server.RequestHandlerClass.mimetypes['json']
+
+        # A 304 has no body, its length would be the one of the file
+        length = len(body) if code != 304 else None
+        head = self.head(code, message, content_type, keep_alive, length, coding, version=version, headers=headers)
+        if isinstance(body, _FileProducer):
+            self.push(head)
+            self.push_with_producer(body)
+        else:
+            self.push(head + body)
+        self.finish(keep_alive)
+
+    def finish(self, keep_alive):
+        """
+        the response is queued, go on with the next request or close
+        """
+        if self.closing or not self.connected:
+            return
+
+        self.last_activity = time.time()
+        self.busy = False
+        if keep_alive:
+            self.next_request()
+        else:
+            self.pending.clear()
+            self.closing = True
+            self.close_when_done()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """
+    Event loop based server, the alternative of the (Threaded)HTTPServer
+    """
+    request_queue_size = 1024
+
+    def __init__(self, server_address, RequestHandlerClass, threads=0, queue_size=0):
+        asyncore.dispatcher.__init__(self)
+        self.RequestHandlerClass = RequestHandlerClass
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(self.request_queue_size)
+
+        self.threads = threads
+        self.queue_size = queue_size
+
+        # Created when serving starts, so that every pre-forked worker has its own
+        self.trigger = None
+        self.pool = None
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        AsyncHTTPChannel(self, *pair)
+
+    def serve_forever(self):
+        self.trigger = _Trigger()
+        if self.threads > 0:
+            self.pool = WorkerPool(self.threads, self.queue_size, name="asyncd")
+
+        timeout = self.RequestHandlerClass.keepalive_timeout
+        next_sweep = time.time() + 1
+        while asyncore.socket_map:
+            asyncore.loop(timeout=1.0, use_poll=True, count=1)
+
+            now = time.time()
+            if timeout > 0 and now >= next_sweep:
+                self.close_idle_channels(now - timeout)
+                next_sweep = now + 1
+
+    def close_idle_channels(self, idle_since):
+        for channel in asyncore.socket_map.values():
+            # Channels still sending a response aren't idle
+            if isinstance(channel, AsyncHTTPChannel) and not channel.busy and not channel.producer_fifo and \
+                    channel.last_activity < idle_since:
+                channel.close()
+
+    def server_close(self):
+        self.close()
+        if self.trigger is not None:
+            self.trigger.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
@@ -0,0 +1,176 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Extended JSON encoding and decoding of requests and responses.
+
+Two backends give the same results:
+
+json_util: json with the bson.json_util hooks, called for every object
+fast: one reused encoder and decoder, the common types (ObjectId,
+      datetime, regex) are handled by a table lookup on their type,
+      everything else falls back to json_util
+"""
+
+# noinspection PyPackageRequirements
+from bson import json_util
+# noinspection PyPackageRequirements
+from bson.objectid import ObjectId
+# noinspection PyPackageRequirements
+from bson.son import SON
+
+import calendar
+import datetime
+import re
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+RE_TYPE = type(re.compile(""))
+
+BACKENDS = ("json_util", "fast")
+
+
+def _json_util_loads(s):
+    return json.loads(s, object_hook=json_util.object_hook)
+
+
+def _json_util_dumps(obj):
+    return json.dumps(obj, default=json_util.default)
+
+
+def _encode_datetime(obj):
+    if obj.utcoffset() is not None:
+        obj = obj - obj.utcoffset()
+    return {"$date": int(calendar.timegm(obj.timetuple()) * 1000 + obj.microsecond / 1000)}
+
+
+def _encode_regex(obj):
+    flags = ""
+    if obj.flags & re.IGNORECASE:
+        flags += "i"
+    if obj.flags & re.LOCALE:
+        flags += "l"
+    if obj.flags & re.MULTILINE:
+        flags += "m"
+    if obj.flags & re.DOTALL:
+        flags += "s"
+    if obj.flags & re.UNICODE:
+        flags += "u"
+    if obj.flags & re.VERBOSE:
+        flags += "x"
+
+    pattern = obj.pattern
+    if not isinstance(pattern, unicode):
+        pattern = pattern.decode('utf-8')
+    return SON([("$regex", pattern), ("$options", flags)])
+
+
+_encoders = {ObjectId: lambda obj: {"$oid": str(obj)},
+             datetime.datetime: _encode_datetime,
+             RE_TYPE: _encode_regex}
+
+_decoders = {"$oid": lambda dct: ObjectId(str(dct["$oid"]))}
+
+
+def _fast_default(obj):
+    encode = _encoders.get(type(obj))
+    if encode is None:
+        return json_util.default(obj)
+    return encode(obj)
+
+
+def _fast_object_hook(dct):
+    # Extended JSON values are objects of at most 3 keys starting with $
+    if len(dct) > 3:
+        return dct
+
+    for k in dct:
+        if k[:1] == '$':
+            break
+    else:
+        return dct
+
+    if len(dct) == 1:
+        decode = _decoders.get(k)
+        if decode is not None:
+            return decode(dct)
+    return json_util.object_hook(dct)
+
+
+_encoder = json.JSONEncoder(default=_fast_default)
+_decoder = json.JSONDecoder(object_hook=_fast_object_hook)
+
+
+def _fast_loads(s):
+    return _decoder.decode(s)
+
+
+def _fast_dumps(obj):
+    return _encoder.encode(obj)
+
+
+def _check_fast_backend():
+    """
+    drop the native encoders and decoders whose output differs from json_util's in this pymongo version
+    """
+    samples = {ObjectId: ObjectId(),
+               datetime.datetime: datetime.datetime(2015, 2, 24, 13, 45, 10, 123456),
+               RE_TYPE: re.compile("^a.c$", re.IGNORECASE | re.MULTILINE)}
+
+    for t, sample in samples.items():
+        try:
+            if _fast_dumps([sample]) == _json_util_dumps([sample]):
+                continue
+        except Exception:
+            pass
+        del _encoders[t]
+
+    s = _json_util_dumps(samples[ObjectId])
+    try:
+        if _fast_loads(s) == _json_util_loads(s):
+            return
+    except Exception:
+        pass
+    del _decoders["$oid"]
+
+
+_check_fast_backend()
+
+loads = _json_util_loads
+dumps = _json_util_dumps
+
+
+def loads_ordered(s):
+    """
+    decode s keeping the order of the keys of its objects, as SONs (the
+    name of a command is its first key)
+    """
+    return json.loads(s, object_pairs_hook=lambda pairs: json_util.object_hook(SON(pairs)))
+
+
+def use(backend):
+    """
+    select the backend used by loads and dumps
+    """
+    global loads, dumps
+
+    if backend == "json_util":
+        loads, dumps = _json_util_loads, _json_util_dumps
+    elif backend == "fast":
+        loads, dumps = _fast_loads, _fast_dumps
+    else:
+        raise ValueError("unknown codec: %s" % backend)
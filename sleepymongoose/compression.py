@@ -0,0 +1,75 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+gzip and deflate content coding of responses
+"""
+
+import zlib
+
+# Preferred first when the client accepts both equally
+CODINGS = ("gzip", "deflate")
+
+# Besides text/*, the types worth compressing
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "application/x-ndjson",
+                      "image/vnd.microsoft.icon", "image/svg+xml")
+
+
+def negotiate(accept_encoding):
+    """
+    the coding of a response to a request with this Accept-Encoding header, None for no coding
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            (k, eq, v) = param.partition('=')
+            if k.strip() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+
+    best = None
+    for coding in CODINGS:
+        q = qualities.get(coding, qualities.get("*", 0.0))
+        if q > 0 and (best is None or q > qualities.get(best, qualities.get("*", 0.0))):
+            best = coding
+    return best
+
+
+def compressible(content_type):
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def compressor(coding, level):
+    """
+    a zlib compressor writing the format of coding
+    """
+    if coding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    # HTTP deflate is the zlib format
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+
+def compress(data, coding, level):
+    c = compressor(coding, level)
+    return c.compress(data) + c.flush()
@@ -0,0 +1,205 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict, deque
+
+import threading
+import time
+
+
+class CursorEntry:
+    """
+    A registered cursor and its bookkeeping
+    """
+
+    def __init__(self, _id, cursor, ns):
+        self.id = _id
+        self.cursor = cursor
+        self.ns = ns
+        self.created = self.last_used = time.time()
+
+        # Held while the cursor is iterated, pymongo cursors aren't thread safe
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # Documents read ahead by a prefetch, as (document, size) pairs, and
+        # the error the prefetch ran into, raised after the buffered documents
+        self.buffer = deque()
+        self.buffered_bytes = 0
+        self.error = None
+
+    def close(self):
+        self.closed = True
+        self.buffer.clear()
+        self.buffered_bytes = 0
+
+        close = getattr(self.cursor, "close", None)
+        if callable(close):
+            close()
+
+
+class CursorRegistry:
+    """
+    The cursors opened by the handlers, in least recently used order.
+
+    Cursors are closed when they are exhausted, when they weren't used for
+    ttl seconds, or when there are more than max_cursors of them (the least
+    recently used one goes first). Exhausted ids are remembered for a while,
+    so that _more can still answer them with an empty batch.
+    """
+
+    def __init__(self, ttl=600, max_cursors=1000):
+        self.ttl = ttl
+        self.max_cursors = max_cursors
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.exhausted = OrderedDict()
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, cursor, ns=None):
+        """
+        register a cursor, returns its entry
+        """
+        self.reap()
+
+        with self.lock:
+            entry = CursorEntry(self.next_id, cursor, ns)
+            self.next_id += 1
+            self.entries[entry.id] = entry
+
+            evicted = []
+            if self.max_cursors > 0:
+                for entry_id in self.entries.keys():
+                    if len(self.entries) - len(evicted) <= self.max_cursors:
+                        break
+                    evicted.append(self.entries[entry_id])
+
+            evicted = [e for e in evicted if self._pop_idle(e)]
+
+        for e in evicted:
+            e.close()
+
+        return entry
+
+    def get(self, _id):
+        """
+        the entry of a live cursor, marked as used now
+        """
+        # A cursor idle for more than ttl seconds is closed rather than served
+        self.reap()
+
+        with self.lock:
+            entry = self.entries.get(_id)
+            if entry is not None:
+                entry.last_used = time.time()
+                # Move to the most recently used end
+                del self.entries[_id]
+                self.entries[_id] = entry
+            return entry
+
+    def add_exhausted(self):
+        """
+        an id for a result which was complete without a cursor
+        """
+        with self.lock:
+            _id = self.next_id
+            self.next_id += 1
+            self._mark_exhausted(_id)
+        return _id
+
+    def _mark_exhausted(self, _id):
+        self.exhausted[_id] = time.time()
+        while self.max_cursors > 0 and len(self.exhausted) > self.max_cursors:
+            self.exhausted.popitem(last=False)
+
+    def is_exhausted(self, _id):
+        with self.lock:
+            return _id in self.exhausted
+
+    def exhaust(self, entry):
+        """
+        close the cursor of entry, it has no more results
+        """
+        with self.lock:
+            if self.entries.pop(entry.id, None) is None:
+                return
+            self._mark_exhausted(entry.id)
+
+        entry.close()
+
+    def remove(self, _id):
+        with self.lock:
+            entry = self.entries.pop(_id, None)
+            self.exhausted.pop(_id, None)
+
+        if entry is not None:
+            entry.close()
+        return entry is not None
+
+    def reap(self):
+        """
+        close the cursors which weren't used for ttl seconds
+        """
+        if self.ttl <= 0:
+            return
+
+        expired = []
+        deadline = time.time() - self.ttl
+
+        with self.lock:
+            for entry in self.entries.values():
+                if entry.last_used >= deadline:
+                    break
+                if self._pop_idle(entry):
+                    expired.append(entry)
+
+            for _id, exhausted in self.exhausted.items():
+                if exhausted >= deadline:
+                    break
+                del self.exhausted[_id]
+
+        for entry in expired:
+            entry.close()
+
+    def _pop_idle(self, entry):
+        """
+        unregister entry unless it is being iterated right now, call with self.lock held
+        """
+        if not entry.lock.acquire(False):
+            return False
+        try:
+            del self.entries[entry.id]
+        finally:
+            entry.lock.release()
+        return True
+
+    def list(self):
+        """
+        the live cursors, least recently used first
+        """
+        self.reap()
+
+        now = time.time()
+        with self.lock:
+            return [{"id": e.id,
+                     "ns": e.ns,
+                     "age": round(now - e.created, 3),
+                     "idle": round(now - e.last_used, 3),
+                     "prefetched": len(e.buffer),
+                     "created": e.created,
+                     "last_used": e.last_used} for e in self.entries.values()]
@@ -17,11 +17,31 @@
 # noinspection PyPackageRequirements
 from bson.son import SON
 # noinspection PyPackageRequirements
-from bson import json_util
+from bson import json_util, BSON
+# noinspection PyPackageRequirements
+from bson.objectid import ObjectId
 from pymongo import Connection, ASCENDING, DESCENDING
 from pymongo.errors import ConnectionFailure, ConfigurationError, OperationFailure, AutoReconnect
 
+try:
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # pymongo < 2.7, no bulk operations
+    BulkWriteError = None
+
+from cache import TTLCache
+import codec
+from cursors import CursorRegistry
+import metrics
+from pool import WorkerPool
+from writebehind import WriteBehind
+
+import csv
 import re
+import threading
+import Queue
+
+from cStringIO import StringIO
 
 try:
     import json
@@ -33,13 +53,133 @@ def esc(s):
     return str(s).replace('"', '\\"')
 
 
+def arg(args, key, default=None):
+    """
+    get an argument, a list of strings (like parse_qs gives) is unwrapped to its first value
+    """
+    value = args.get(key, default)
+    if isinstance(value, list) and len(value) and isinstance(value[0], basestring):
+        return value[0]
+    return value
+
+
+def flag(args, key):
+    """
+    get a boolean argument, 1, true, yes and on are true
+    """
+    value = arg(args, key, False)
+    if isinstance(value, basestring):
+        return value.lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def bson_results(docs, _id):
+    """
+    the BSON of {"results": docs, "id": _id, "ok": 1}
+    """
+    return BSON.encode(SON([("results", docs), ("id", _id), ("ok", 1)]))
+
+
 class MongoHandler:
     mh = None
 
-    _cursor_id = 0
+    # Cursors are closed after cursor_ttl idle seconds, or when there are
+    # more than max_cursors of them (0 = no limit)
+    cursor_ttl = 600
+    max_cursors = 1000
+
+    # Threads reading ahead the next batch of cursors with prefetch=1 (0 =
+    # no prefetching), at most prefetch_max_bytes are buffered per cursor
+    prefetch_threads = 2
+    prefetch_max_bytes = 1048576
+
+    # Results of _find queries which fit in one batch are cached for
+    # query_cache_ttl seconds (query_cache_size = 0 disables the cache)
+    query_cache_size = 0
+    query_cache_ttl = 5
+
+    # Results of _count and _distinct are cached for count_cache_ttl
+    # seconds (count_cache_size = 0 disables the cache)
+    count_cache_size = 0
+    count_cache_ttl = 2
+
+    # Commands run through _cmd which never write, the cached results of the
+    # db are kept when they run (lower case, aggregate and mapReduce can write)
+    read_only_commands = ("count", "distinct", "group", "geonear", "geosearch", "find", "explain", "ping",
+                          "ismaster", "buildinfo", "hostinfo", "serverstatus", "dbstats", "collstats",
+                          "listcollections", "listindexes", "listdatabases", "currentop", "top",
+                          "getlasterror", "getlog", "getparameter", "getcmdlineopts", "connectionstatus",
+                          "whatsmyuri", "replsetgetstatus", "usersinfo", "rolesinfo", "dbhash", "validate")
+
+    # Unique keys of collections, used to build the criteria of upserts,
+    # are cached for index_cache_ttl seconds (0 = always ask the server)
+    index_cache_ttl = 60
+
+    # Threads running the commands of unordered (ordered=0) batches, 0 = run them one by one
+    batch_threads = 4
+
+    # _import inserts the documents of import_chunk_size bytes of lines at
+    # once, longer lines than import_max_line are rejected and the first
+    # import_max_errors failed lines are listed
+    import_chunk_size = 1048576
+    import_max_line = 16777216
+    import_max_errors = 100
+
+    # Content types of the _export formats
+    export_types = {"ndjson": "application/x-ndjson",
+                    "csv": "text/csv"}
+
+    # Handlers which output BSON with format=bson (or Accept: application/bson)
+    bson_handlers = ("_find", "_more", "_cmd", "_aggregate")
+    bson_type = "application/bson"
+
+    # _insert only buffers the documents of the write_behind collections
+    # ("db.collection"), they are inserted in bulk once write_behind_docs of
+    # them are waiting or after write_behind_delay seconds. At most
+    # write_behind_max_buffered documents are buffered, an _insert waits up
+    # to write_behind_wait seconds for room
+    write_behind = ()
+    write_behind_docs = 1000
+    write_behind_delay = 0.05
+    write_behind_max_buffered = 10000
+    write_behind_wait = 5
 
     def __init__(self, mongos):
         self.connections = {}
+        self.cursors = CursorRegistry(MongoHandler.cursor_ttl, MongoHandler.max_cursors)
+
+        self.prefetch_pool = None
+        if MongoHandler.prefetch_threads > 0:
+            self.prefetch_pool = WorkerPool(MongoHandler.prefetch_threads, MongoHandler.max_cursors,
+                                            name="prefetch")
+
+        self.query_cache = None
+        if MongoHandler.query_cache_size > 0:
+            self.query_cache = TTLCache(MongoHandler.query_cache_size, MongoHandler.query_cache_ttl)
+
+        self.count_cache = None
+        if MongoHandler.count_cache_size > 0:
+            self.count_cache = TTLCache(MongoHandler.count_cache_size, MongoHandler.count_cache_ttl)
+
+        self.batch_pool = None
+        if MongoHandler.batch_threads > 0:
+            self.batch_pool = WorkerPool(MongoHandler.batch_threads, 1000, name="batch")
+
+        self.index_cache = None
+        if MongoHandler.index_cache_ttl > 0:
+            self.index_cache = TTLCache(10000, MongoHandler.index_cache_ttl)
+
+        self.write_behind = None
+        if MongoHandler.write_behind:
+            self.write_behind = WriteBehind(self.__write_behind_insert, MongoHandler.write_behind_docs,
+                                            MongoHandler.write_behind_delay, MongoHandler.write_behind_max_buffered)
+
+        # Bumped on every write through the proxy, per (name, db) and (name, db, collection),
+        # cached results of older generations are never read again
+        self.generations = {}
+
+        # Guards connections and generations when serving from several threads
+        self.lock = threading.RLock()
 
         for host in mongos:
             args = {"server": host}
@@ -57,15 +197,21 @@ class MongoHandler:
         if name is None:
             name = "default"
 
-        if name in self.connections:
-            return self.connections[name]
+        connection = self.connections.get(name)
+        if connection is not None:
+            return connection
 
         try:
             connection = Connection(uri, network_timeout=2)
         except (ConnectionFailure, ConfigurationError):
             return None
 
-        self.connections[name] = connection
+        with self.lock:
+            if name in self.connections:
+                # Another thread connected in the meantime, use that one
+                connection.disconnect()
+                return self.connections[name]
+            self.connections[name] = connection
         return connection
 
     def _get_host_and_port(self, server):
@@ -99,16 +245,23 @@ class MongoHandler:
         else:
             return json_util.object_hook(obj)
 
-    def _get_json(self, s, out):
-        try:
-            obj = json.loads(s, object_hook=json_util.object_hook)
-        except (ValueError, TypeError):
-            print "Error: Couldn't parse JSON:", s
-            out('{"ok": 0, "err": "couldn\'t parse JSON: %s"}' % esc(s))
-            return None
+    def _get_json(self, s, out, ordered=False):
+        """
+        decode a JSON argument, the arguments of application/json requests are already decoded
+        """
+        if not isinstance(s, basestring):
+            obj = s
+        else:
+            try:
+                with metrics.phase("decode"):
+                    obj = codec.loads_ordered(s) if ordered else codec.loads(s)
+            except (ValueError, TypeError):
+                print "Error: Couldn't parse JSON:", s
+                out('{"ok": 0, "err": "couldn\'t parse JSON: %s"}' % esc(s))
+                return None
 
         if not getattr(obj, '__iter__', False):
-            out('{"ok": 0, "err": "type is not iterable: %s"}' % s)
+            out('{"ok": 0, "err": "type is not iterable: %s"}' % esc(s))
             return None
 
         return obj
@@ -118,17 +271,27 @@ class MongoHandler:
         if name is None:
             name = "default"
 
+        bson = arg(args, 'format') == "bson"
+        if bson:
+            out = BsonOut(out)
+
         conn = self._get_connection(name)
         if conn is None:
             out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
             return
 
-        cmd = self._get_json(args['cmd'], out)
+        cmd = self._get_json(args['cmd'], out, ordered=True)
         if cmd is None:
             return
 
+        # The command is named by the first key, the keys of an already decoded object aren't in order
+        command = None
+        if isinstance(cmd, SON) or (isinstance(cmd, dict) and len(cmd) == 1):
+            command = next(iter(cmd), None)
+
         try:
-            result = conn[db].command(cmd, check=False)
+            with metrics.phase("mongo"):
+                result = conn[db].command(cmd, check=False)
         except AutoReconnect:
             out('{"ok": 0, "err": "wasn\'t connected to the db and ' +
                 'couldn\'t reconnect", "name": "%s"}' % name)
@@ -137,11 +300,19 @@ class MongoHandler:
             out('{"ok": 0, "err": "%s"}' % error)
             return
 
+        # Other commands may write anything in the db (drop, findAndModify, createIndexes, ...)
+        if not isinstance(command, basestring) or command.lower() not in MongoHandler.read_only_commands:
+            self.__invalidate(name, db)
+            self.__flush_indexes(name, db)
+
         # debugging
         if result['ok'] == 0:
             result['cmd'] = args['cmd']
 
-        out(json.dumps(result, default=json_util.default))
+        if bson:
+            out.raw(BSON.encode(result))
+        else:
+            out(codec.dumps(result))
 
     # noinspection PyUnusedLocal
     def _hello(self, args, out, name=None, db=None, collection=None):
@@ -152,12 +323,24 @@ class MongoHandler:
 
     # noinspection PyUnusedLocal
     def _status(self, args, out, name=None, db=None, collection=None):
-        result = {"ok": 1, "connections": {}}
+        result = {"ok": 1, "connections": {}, "cursors": len(self.cursors)}
 
-        for name, conn in self.connections.iteritems():
+        with self.lock:
+            connections = self.connections.items()
+
+        for name, conn in connections:
             result['connections'][name] = "%s:%d" % (conn.host, conn.port)
 
-        out(json.dumps(result))
+        if self.query_cache is not None:
+            result['query_cache'] = self.query_cache.stats()
+        if self.count_cache is not None:
+            result['count_cache'] = self.count_cache.stats()
+        if self.index_cache is not None:
+            result['index_cache'] = self.index_cache.stats()
+        if self.write_behind is not None:
+            result['write_behind'] = self.write_behind.stats()
+
+        out(codec.dumps(result))
 
     # noinspection PyUnusedLocal
     def _connect(self, args, out, name=None, db=None, collection=None):
@@ -219,7 +402,8 @@ class MongoHandler:
             return
 
         conn.disconnect()
-        del self.connections[name]
+        with self.lock:
+            self.connections.pop(name, None)
 
         out('{"ok": 1}')
 
@@ -238,28 +422,29 @@ class MongoHandler:
 
         criteria = {}
         if 'criteria' in args:
-            criteria = self._get_json(args['criteria'][0], out)
+            criteria = self._get_json(args['criteria'], out)
             if None == criteria:
                 return
 
         fields = None
         if 'fields' in args:
-            fields = self._get_json(args['fields'][0], out)
+            fields = self._get_json(args['fields'], out)
             if fields is None:
                 return
 
         limit = 0
         if 'limit' in args:
-            limit = int(args['limit'][0])
+            limit = int(arg(args, 'limit'))
 
         skip = 0
         if 'skip' in args:
-            skip = int(args['skip'][0])
+            skip = int(arg(args, 'skip'))
 
         cursor = conn[db][collection].find(spec=criteria, fields=fields, limit=limit, skip=skip)
 
+        sort = None
         if 'sort' in args:
-            sort = self._get_json(args['sort'][0], out)
+            sort = self._get_json(args['sort'], out)
             if sort is None:
                 return
 
@@ -273,69 +458,566 @@ class MongoHandler:
 
             cursor.sort(stupid_sort)
 
-        if 'explain' in args and bool(args['explain'][0]):
-            out(json.dumps({"results": [cursor.explain()], "ok": 1}, default=json_util.default))
+        batch_size = 15
+        if 'batch_size' in args:
+            batch_size = int(arg(args, 'batch_size'))
 
-        if not hasattr(self, "cursors"):
-            setattr(self, "cursors", {})
+        bson = arg(args, 'format') == "bson"
+        if bson:
+            out = BsonOut(out)
 
-        _id = MongoHandler._cursor_id
-        MongoHandler._cursor_id += 1
+        if flag(args, 'explain'):
+            if bson:
+                out.raw(BSON.encode(SON([("results", [cursor.explain()]), ("ok", 1)])))
+            else:
+                out(codec.dumps({"results": [cursor.explain()], "ok": 1}))
+
+        cache_key = None
+        if self.query_cache is not None and not flag(args, 'explain'):
+            cache_key = self.__query_key(name, db, collection, criteria, fields, sort, limit, skip, batch_size)
+            batch = self.query_cache.get(cache_key)
+            if batch is not None:
+                # The query is never sent, the cursor is just dropped
+                if bson:
+                    out.raw(bson_results(batch, self.cursors.add_exhausted()))
+                else:
+                    out(codec.dumps({"results": batch, "id": self.cursors.add_exhausted(), "ok": 1}))
+                return
+
+        entry = self.cursors.add(cursor, "%s.%s" % (db, collection))
+
+        with entry.lock:
+            batch = self.__output_results(entry, out, batch_size, flag(args, 'stream'), bson)
 
-        cursors = getattr(self, "cursors")
-        cursors[_id] = cursor
-        setattr(cursor, "id", _id)
+        if cache_key is not None and batch is not None:
+            self.query_cache.set(cache_key, batch)
+
+        if flag(args, 'prefetch'):
+            self.__prefetch(entry, batch_size)
+
+    def _aggregate(self, args, out, name=None, db=None, collection=None):
+        """
+        run an aggregation pipeline, its results are paged through with _more like the ones of _find
+        """
+        conn = self._get_connection(name)
+        if conn is None:
+            out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
+            return
+
+        if db is None or collection is None:
+            out('{"ok": 0, "err": "db and collection must be defined"}')
+            return
+
+        if 'pipeline' not in args:
+            out('{"ok": 0, "err": "missing pipeline"}')
+            return
+
+        pipeline = self._get_json(args['pipeline'], out)
+        if pipeline is None:
+            return
+        if isinstance(pipeline, dict):
+            pipeline = [pipeline]
+        if not isinstance(pipeline, list) or not all(isinstance(stage, dict) for stage in pipeline):
+            out('{"ok": 0, "err": "pipeline must be a list of stages"}')
+            return
+
+        # The results always come back in a cursor, batchSize only sets the size of its batches
+        options = {"cursor": {}}
+        try:
+            if 'batchSize' in args:
+                options['cursor']['batchSize'] = int(arg(args, 'batchSize'))
+            if 'maxTimeMS' in args:
+                options['maxTimeMS'] = int(arg(args, 'maxTimeMS'))
+        except ValueError:
+            out('{"ok": 0, "err": "batchSize and maxTimeMS must be numbers"}')
+            return
+        if 'allowDiskUse' in args:
+            options['allowDiskUse'] = flag(args, 'allowDiskUse')
 
         batch_size = 15
         if 'batch_size' in args:
-            batch_size = int(args['batch_size'][0])
+            batch_size = int(arg(args, 'batch_size'))
+
+        bson = arg(args, 'format') == "bson"
+        if bson:
+            out = BsonOut(out)
+
+        try:
+            with metrics.phase("mongo"):
+                cursor = conn[db][collection].aggregate(pipeline, **options)
+        except (AutoReconnect, OperationFailure), e:
+            out('{"ok": 0, "err": %s}' % codec.dumps(str(e)))
+            return
+        finally:
+            if pipeline and isinstance(pipeline[-1].get('$out'), basestring):
+                # The results were written to a collection
+                self.__invalidate(name, db, pipeline[-1]['$out'])
+
+        if 'batchSize' in options['cursor']:
+            cursor.batch_size(options['cursor']['batchSize'])
 
-        self.__output_results(cursor, out, batch_size)
+        entry = self.cursors.add(cursor, "%s.%s" % (db, collection))
+
+        with entry.lock:
+            self.__output_results(entry, out, batch_size, flag(args, 'stream'), bson)
+
+        if flag(args, 'prefetch'):
+            self.__prefetch(entry, batch_size)
+
+    def _count(self, args, out, name=None, db=None, collection=None):
+        """
+        count the documents matching criteria, limit and skip are applied when given
+        """
+        conn = self._get_connection(name)
+        if conn is None:
+            out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
+            return
+
+        if db is None or collection is None:
+            out('{"ok": 0, "err": "db and collection must be defined"}')
+            return
+
+        criteria = {}
+        if 'criteria' in args:
+            criteria = self._get_json(args['criteria'], out)
+            if criteria is None:
+                return
+
+        try:
+            limit = int(arg(args, 'limit', 0))
+            skip = int(arg(args, 'skip', 0))
+        except ValueError:
+            out('{"ok": 0, "err": "limit and skip must be numbers"}')
+            return
+
+        hint = None
+        if 'hint' in args:
+            hint = self.__hint(args, out)
+            if hint is None:
+                return
+
+        cache_key = None
+        if self.count_cache is not None:
+            cache_key = self.__query_key(name, db, collection, "_count", criteria, limit, skip, hint)
+            n = self.count_cache.get(cache_key)
+            if n is not None:
+                out('{"ok": 1, "n": %d}' % n)
+                return
+
+        cursor = conn[db][collection].find(spec=criteria, limit=limit, skip=skip)
+        if hint is not None:
+            cursor.hint(hint)
+
+        try:
+            with metrics.phase("mongo"):
+                n = cursor.count(with_limit_and_skip=True)
+        except (AutoReconnect, OperationFailure), e:
+            out('{"ok": 0, "err": %s}' % codec.dumps(str(e)))
+            return
+
+        if cache_key is not None:
+            self.count_cache.set(cache_key, n)
+
+        out('{"ok": 1, "n": %d}' % n)
+
+    def __hint(self, args, out):
+        """
+        the index of a hint argument, an index name or a JSON index specification
+        """
+        hint = arg(args, 'hint')
+        if isinstance(hint, basestring) and hint[:1] not in ('{', '['):
+            return hint
+
+        hint = self._get_json(hint, out)
+        if hint is None:
+            return None
+
+        # [["a", 1], ["b", -1]] keeps the order of the keys of compound indexes
+        if isinstance(hint, dict) and hint:
+            return hint.items()
+        if isinstance(hint, list) and hint and all(isinstance(key, list) and len(key) == 2 for key in hint):
+            return [tuple(key) for key in hint]
+
+        out('{"ok": 0, "err": "invalid hint"}')
+        return None
+
+    def _distinct(self, args, out, name=None, db=None, collection=None):
+        """
+        the distinct values of key in the documents matching criteria
+        """
+        conn = self._get_connection(name)
+        if conn is None:
+            out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
+            return
+
+        if db is None or collection is None:
+            out('{"ok": 0, "err": "db and collection must be defined"}')
+            return
+
+        key = arg(args, 'key')
+        if not isinstance(key, basestring) or not key:
+            out('{"ok": 0, "err": "missing key"}')
+            return
+
+        criteria = {}
+        if 'criteria' in args:
+            criteria = self._get_json(args['criteria'], out)
+            if criteria is None:
+                return
+
+        cache_key = None
+        if self.count_cache is not None:
+            cache_key = self.__query_key(name, db, collection, "_distinct", key, criteria)
+            values = self.count_cache.get(cache_key)
+            if values is not None:
+                out(values)
+                return
+
+        try:
+            with metrics.phase("mongo"):
+                values = conn[db][collection].find(spec=criteria).distinct(key)
+        except (AutoReconnect, OperationFailure), e:
+            out('{"ok": 0, "err": %s}' % codec.dumps(str(e)))
+            return
+
+        # The encoded response is cached, it is the same for everyone
+        with metrics.phase("encode"):
+            values = codec.dumps({"ok": 1, "values": values})
+
+        if cache_key is not None:
+            self.count_cache.set(cache_key, values)
+
+        out(values)
 
     # noinspection PyUnusedLocal
     def _more(self, args, out, name=None, db=None, collection=None):
         """
         Get more results from a cursor
         """
+        bson = arg(args, 'format') == "bson"
+        if bson:
+            out = BsonOut(out)
+
         if 'id' not in args:
             out('{"ok": 0, "err": "no cursor id given"}')
             return
 
-        _id = int(args["id"][0])
-        cursors = getattr(self, "cursors")
+        _id = int(arg(args, 'id'))
 
-        if _id not in cursors:
-            out('{"ok": 0, "err": "couldn\'t find the cursor with id %d"}' % _id)
+        entry = self.cursors.get(_id)
+        if entry is None:
+            if self.cursors.is_exhausted(_id):
+                if bson:
+                    out.raw(bson_results([], _id))
+                else:
+                    out(codec.dumps({"results": [], "id": _id, "ok": 1}))
+            else:
+                out('{"ok": 0, "err": "couldn\'t find the cursor with id %d"}' % _id)
             return
 
-        cursor = cursors[_id]
-
         batch_size = 15
         if 'batch_size' in args:
-            batch_size = int(args['batch_size'][0])
+            batch_size = int(arg(args, 'batch_size'))
+
+        with entry.lock:
+            self.__output_results(entry, out, batch_size, flag(args, 'stream'), bson)
+
+        if flag(args, 'prefetch'):
+            self.__prefetch(entry, batch_size)
+
+    # noinspection PyUnusedLocal
+    def _cursors(self, args, out, name=None, db=None, collection=None):
+        """
+        list the open cursors
+        """
+        out(codec.dumps({"ok": 1, "cursors": self.cursors.list()}))
+
+    def _export(self, args, out, name=None, db=None, collection=None):
+        """
+        output all the results of a query, as NDJSON (default) or as CSV
+        (format=csv) with the fields of the fields projection as columns
+        """
+        conn = self._get_connection(name)
+        if conn is None:
+            out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
+            return
+
+        if db is None or collection is None:
+            out('{"ok": 0, "err": "db and collection must be defined"}')
+            return
+
+        export_format = arg(args, 'format', "ndjson")
+        if export_format not in MongoHandler.export_types:
+            out('{"ok": 0, "err": "unknown format: %s"}' % esc(export_format))
+            return
+
+        try:
+            limit = int(arg(args, 'limit', 0))
+            skip = int(arg(args, 'skip', 0))
+            batch_size = int(arg(args, 'batch_size', 1000))
+        except (ValueError, TypeError):
+            out('{"ok": 0, "err": "limit, skip and batch_size must be numbers"}')
+            return
+
+        criteria = {}
+        if 'criteria' in args:
+            criteria = self._get_json(args['criteria'], out)
+            if criteria is None:
+                return
+
+        fields = None
+        if 'fields' in args:
+            fields = self._get_json(args['fields'], out)
+            if fields is None:
+                return
+
+        columns = None
+        if export_format == "csv":
+            if isinstance(fields, dict):
+                columns = [k for k in fields if fields[k]]
+            elif fields is not None:
+                columns = list(fields)
+            if not columns:
+                out('{"ok": 0, "err": "csv export needs the fields to output"}')
+                return
 
-        self.__output_results(cursor, out, batch_size)
+        sort = None
+        if 'sort' in args:
+            sort = self._get_json(args['sort'], out)
+            if sort is None:
+                return
+
+        cursor = conn[db][collection].find(spec=criteria, fields=fields, limit=limit, skip=skip)
+        cursor.batch_size(batch_size)
+        if sort is not None:
+            cursor.sort([[k, DESCENDING if sort[k] == -1 else ASCENDING] for k in sort])
 
-    def __output_results(self, cursor, out, batch_size=15):
+        # The cursor is closed as well when writing fails because the client went away
+        try:
+            try:
+                results = iter(cursor)
+                doc = next(results, None)
+            except Exception, e:
+                out('{"ok": 0, "err": "%s"}' % esc(e))
+                return
+
+            if columns is None:
+                while doc is not None:
+                    out(codec.dumps(doc) + "\n")
+                    doc = next(results, None)
+                return
+
+            line = StringIO()
+            writer = csv.writer(line)
+            writer.writerow([c.encode('utf-8') if isinstance(c, unicode) else c for c in columns])
+            while doc is not None:
+                writer.writerow([self.__csv_value(doc, c) for c in columns])
+                out(line.getvalue())
+                line.seek(0)
+                line.truncate()
+                doc = next(results, None)
+            out(line.getvalue())
+        finally:
+            cursor.close()
+
+    # noinspection PyMethodMayBeStatic
+    def __csv_value(self, doc, column):
         """
-        Iterate through the next batch
+        the CSV value of a (dotted) field of doc
+        """
+        value = doc
+        for key in column.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                return ""
+            value = value[key]
+
+        if value is None:
+            return ""
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, (str, bool, int, long, float)):
+            return value
+        if isinstance(value, (dict, list)):
+            return codec.dumps(value)
+        return str(value)
+
+    # noinspection PyUnusedLocal
+    def _metrics(self, args, out, name=None, db=None, collection=None):
         """
+        request counts, latencies and traffic in the Prometheus text format
+        """
+        gauges = [("sleepymongoose_cursors", "Open cursors", len(self.cursors)),
+                  ("sleepymongoose_connections", "Open mongo connections", len(self.connections))]
+        if self.query_cache is not None:
+            gauges.append(("sleepymongoose_query_cache_entries", "Cached _find results", len(self.query_cache)))
+        if self.write_behind is not None:
+            gauges.append(("sleepymongoose_write_behind_buffered", "Documents waiting to be inserted",
+                           self.write_behind.buffered))
+        out(metrics.registry.render(gauges))
+
+    def response_type(self, func_name, args):
+        """
+        the content type of the output of a handler, and whether it must be
+        sent as it is written (None = JSON, streamed if stream=1)
+        """
+        if func_name == "_metrics":
+            return metrics.CONTENT_TYPE, False
+        if func_name == "_export":
+            return MongoHandler.export_types.get(arg(args, 'format'), MongoHandler.export_types['ndjson']), True
+        if func_name in MongoHandler.bson_handlers and arg(args, 'format') == "bson":
+            # The length of a BSON document comes first, it can't be streamed
+            return MongoHandler.bson_type, False
+        return None, flag(args, 'stream')
+
+    def __query_key(self, name, db, collection, *query):
+        """
+        The query cache key of a query, it changes when the collection is written
+        """
+        if name is None:
+            name = "default"
+
+        with self.lock:
+            generation = (self.generations.get((name, db), 0), self.generations.get((name, db, collection), 0))
+
+        return name, db, collection, generation, json.dumps(query, sort_keys=True, default=json_util.default)
+
+    def __invalidate(self, name, db, collection=None):
+        """
+        Forget the cached results of a collection, or of a whole db if collection is None
+        """
+        if name is None:
+            name = "default"
+
+        if collection is None:
+            key = (name, db)
+        else:
+            key = (name, db, collection)
+
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def __output_results(self, entry, out, batch_size=15, stream=False, bson=False):
+        """
+        Iterate through the next batch, returns the batch if it was the last one
+        """
+        if stream and not bson:
+            self.__stream_results(entry, out, batch_size)
+            return None
+
         batch = []
 
         try:
-            while len(batch) < batch_size:
-                batch.append(cursor.next())
+            with metrics.phase("mongo"):
+                batch.extend(self.__next_batch(entry, batch_size))
         except AutoReconnect:
-            out(json.dumps({"ok": 0, "err": "auto reconnecting, please try again"}))
-            return
+            out(codec.dumps({"ok": 0, "err": "auto reconnecting, please try again"}))
+            return None
         except OperationFailure, of:
-            out(json.dumps({"ok": 0, "err": "%s" % of}))
+            out(codec.dumps({"ok": 0, "err": "%s" % of}))
+            return None
+
+        with metrics.phase("encode"):
+            if bson:
+                output = bson_results(batch, entry.id)
+            else:
+                output = codec.dumps({"results": batch, "id": entry.id, "ok": 1})
+        if bson:
+            out.raw(output)
+        else:
+            out(output)
+
+        if not entry.cursor.alive and not entry.buffer:
+            self.cursors.exhaust(entry)
+            return batch
+        return None
+
+    def __next_batch(self, entry, batch_size):
+        """
+        Yield the next batch_size documents, the prefetched ones first
+        """
+        n = 0
+        while n < batch_size and entry.buffer:
+            doc, size = entry.buffer.popleft()
+            entry.buffered_bytes -= size
+            n += 1
+            yield doc
+
+        if entry.error is not None:
+            if n > 0:
+                # Return what was read before the error, it is raised next time
+                return
+            error, entry.error = entry.error, None
+            raise error
+
+        cursor = entry.cursor
+        while n < batch_size:
+            # StopIteration ends the batch early
+            yield cursor.next()
+            n += 1
+
+    def __prefetch(self, entry, batch_size):
+        """
+        Read the next batch of entry into its buffer in the background
+        """
+        if self.prefetch_pool is None or not entry.cursor.alive:
             return
-        except StopIteration:
-            # this is so stupid, there's no has_next?
+
+        try:
+            self.prefetch_pool.submit(self.__fill_buffer, entry, batch_size)
+        except Queue.Full:
+            # Too many prefetches are waiting already, the next batch will be read on demand
             pass
 
-        out(json.dumps({"results": batch, "id": cursor.id, "ok": 1}, default=json_util.default))
+    def __fill_buffer(self, entry, batch_size):
+        with entry.lock:
+            if entry.closed or entry.error is not None:
+                return
+
+            try:
+                while len(entry.buffer) < batch_size and entry.buffered_bytes < MongoHandler.prefetch_max_bytes:
+                    doc = entry.cursor.next()
+                    size = len(BSON.encode(doc))
+                    entry.buffer.append((doc, size))
+                    entry.buffered_bytes += size
+            except StopIteration:
+                pass
+            except (AutoReconnect, OperationFailure), e:
+                entry.error = e
+
+    def __stream_results(self, entry, out, batch_size=15):
+        """
+        Output the next batch document by document, without collecting it first
+        """
+        out('{"results": [')
+
+        n = 0
+        err = None
+        docs = self.__next_batch(entry, batch_size)
+        try:
+            while True:
+                with metrics.phase("mongo"):
+                    doc = next(docs, None)
+                if doc is None:
+                    break
+
+                with metrics.phase("encode"):
+                    doc = codec.dumps(doc)
+                if n > 0:
+                    out(', ')
+                out(doc)
+                n += 1
+        except AutoReconnect:
+            err = "auto reconnecting, please try again"
+        except OperationFailure, of:
+            err = "%s" % of
+
+        if err is None and not entry.cursor.alive and not entry.buffer:
+            self.cursors.exhaust(entry)
+
+        if err is None:
+            out('], "id": %d, "ok": 1}' % entry.id)
+        else:
+            out('], "id": %d, "ok": 0, "err": %s}' % (entry.id, codec.dumps(err)))
 
     def _insert(self, args, out, name=None, db=None, collection=None):
         """
@@ -358,11 +1040,92 @@ class MongoHandler:
         if docs is None:
             return
 
+        if self.__write_behind_for(args, db, collection):
+            self.__buffer_insert(docs, out, name, db, collection)
+            return
+
+        write_concern = self.__write_concern(args, out)
+        if write_concern is None:
+            return
+
         try:
-            conn[db][collection].insert(docs)
-            out(json.dumps(conn[db].last_status(), default=json_util.default))
+            with metrics.phase("mongo"):
+                oids = conn[db][collection].insert(docs, **write_concern)
+        except OperationFailure, of:
+            self.__invalidate(name, db, collection)
+            out(self.__write_error(of))
+            return
         except Exception, e:
             out('{"ok": 0, "err": "%s"}' % esc(e.message))
+            return
+
+        self.__invalidate(name, db, collection)
+
+        # An insert is acknowledged with n = 0, like getLastError does
+        status = {"ok": 1}
+        if write_concern['w'] != 0:
+            status.update({"err": None, "n": 0})
+        status['oids'] = oids if isinstance(oids, list) else [oids]
+        out(codec.dumps(status))
+
+    def __write_behind_for(self, args, db, collection):
+        """
+        Whether an _insert goes to the write-behind buffer, one asking for a
+        write concern asks for the write to be done
+        """
+        return self.write_behind is not None and "%s.%s" % (db, collection) in MongoHandler.write_behind and \
+            'w' not in args and 'j' not in args and 'wtimeout' not in args
+
+    def __buffer_insert(self, docs, out, name, db, collection):
+        """
+        Queue docs in the write-behind buffer, they are acknowledged before they are inserted
+        """
+        if isinstance(docs, dict):
+            docs = [docs]
+        for doc in docs:
+            if not isinstance(doc, dict):
+                out('{"ok": 0, "err": "docs must be documents"}')
+                return
+            if '_id' not in doc:
+                doc['_id'] = ObjectId()
+
+        if not self.write_behind.add((name, db, collection), docs, MongoHandler.write_behind_wait):
+            out('{"ok": 0, "err": "write-behind buffer is full"}')
+            return
+
+        out(codec.dumps({"ok": 1, "buffered": len(docs), "oids": [doc['_id'] for doc in docs]}))
+
+    def __write_behind_insert(self, key, docs):
+        """
+        Insert the buffered docs of a collection, returns the number of inserted ones
+        """
+        (name, db, collection) = key
+
+        conn = self._get_connection(name)
+        if conn is None:
+            raise ConnectionFailure("couldn't get connection to mongo")
+
+        try:
+            if BulkWriteError is None:
+                conn[db][collection].insert(docs, continue_on_error=True, w=1)
+                return len(docs)
+
+            bulk = conn[db][collection].initialize_unordered_bulk_op()
+            for doc in docs:
+                bulk.insert(doc)
+            try:
+                return bulk.execute({"w": 1})['nInserted']
+            except BulkWriteError, bwe:
+                return bwe.details['nInserted']
+        finally:
+            self.__invalidate(name, db, collection)
+
+    def close(self):
+        """
+        Insert the documents still in the write-behind buffer
+        """
+        if self.write_behind is not None:
+            self.write_behind.close()
 
     def _update(self, args, out, name=None, db=None, collection=None):
         """
@@ -402,26 +1165,36 @@ class MongoHandler:
             criteria = self._get_json(args['criteria'], out)
         if upsert and not multi and criteria is None:
             # Get the criteria from the object and indices
-            ii = collection.index_information()
             criteria = {}
-            for (ik, o) in ii.items():
-                if ik == '_id_' or 'unique' in o and o['unique']:
-                    key = o['key']
-                    for k in dict(key):
-                        if k in newobj:
-                            criteria[k] = newobj[k]
-                        elif '$set' in newobj and k in newobj['$set']:
-                            criteria[k] = newobj['$set'][k]
+            for key in self.__unique_keys(name, collection):
+                for k in key:
+                    if k in newobj:
+                        criteria[k] = newobj[k]
+                    elif '$set' in newobj and k in newobj['$set']:
+                        criteria[k] = newobj['$set'][k]
 
         if not criteria:
             out('{"ok": 0, "err": "missing criteria"}')
             return
 
+        write_concern = self.__write_concern(args, out)
+        if write_concern is None:
+            return
+
         try:
-            collection.update(criteria, newobj, upsert=upsert, multi=multi, check_keys=False)
-            out(json.dumps(conn[db].last_status(), default=json_util.default))
+            with metrics.phase("mongo"):
+                status = collection.update(criteria, newobj, upsert=upsert, multi=multi, check_keys=False,
+                                           **write_concern)
+        except OperationFailure, of:
+            self.__invalidate(name, db, collection.name)
+            out(self.__write_error(of))
+            return
         except Exception, e:
             out('{"ok": 0, "err": "%s"}' % esc(e.message))
+            return
+
+        self.__invalidate(name, db, collection.name)
+        out(codec.dumps(status or {"ok": 1}))
 
     def _insert_or_update(self, args, out, name=None, db=None, collection=None):
         """
@@ -448,32 +1221,292 @@ class MongoHandler:
             criteria = self._get_json(args['criteria'], out)
             if criteria is None:
                 return
+        write_concern = self.__write_concern(args, out)
+        if write_concern is None:
+            return
+
         try:
-            conn[db][collection].remove(criteria)
-            out(json.dumps(conn[db].last_status()))
+            with metrics.phase("mongo"):
+                status = conn[db][collection].remove(criteria, **write_concern)
+        except OperationFailure, of:
+            self.__invalidate(name, db, collection)
+            out(self.__write_error(of))
+            return
         except Exception, e:
             out('{"ok": 0, "err": "%s"}' % esc(e.message))
+            return
+
+        self.__invalidate(name, db, collection)
+        out(codec.dumps(status or {"ok": 1}))
+
+    # noinspection PyMethodMayBeStatic
+    def __write_concern(self, args, out):
+        """
+        The write concern of a write from its w, j and wtimeout arguments, writes are acknowledged by default
+        """
+        write_concern = {"w": 1}
+        try:
+            if 'w' in args:
+                w = arg(args, 'w')
+                if isinstance(w, basestring) and w.isdigit():
+                    w = int(w)
+                write_concern['w'] = w
+            if 'j' in args:
+                write_concern['j'] = flag(args, 'j')
+            if 'wtimeout' in args:
+                write_concern['wtimeout'] = int(arg(args, 'wtimeout'))
+        except (ValueError, TypeError):
+            out('{"ok": 0, "err": "invalid write concern"}')
+            return None
+        return write_concern
+
+    # noinspection PyMethodMayBeStatic
+    def __write_error(self, of):
+        """
+        The output of a failed write, the server's answer if there is one
+        """
+        if isinstance(of.details, dict) and of.details:
+            return codec.dumps(of.details)
+        return codec.dumps({"ok": 0, "err": str(of), "code": of.code})
+
+    def _bulk_write(self, args, out, name=None, db=None, collection=None):
+        """
+        run a list of insertOne, updateOne, updateMany, replaceOne, deleteOne
+        and deleteMany operations as one bulk operation
+
+        with ordered=0 the operations after a failed one still run
+        """
+        if BulkWriteError is None:
+            out('{"ok": 0, "err": "bulk operations need pymongo 2.7 or later"}')
+            return
+
+        conn = self._get_connection(name)
+        if conn is None:
+            out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
+            return
+
+        if db is None or collection is None:
+            out('{"ok": 0, "err": "db and collection must be defined"}')
+            return
+
+        if "ops" not in args:
+            out('{"ok": 0, "err": "missing ops"}')
+            return
+
+        ops = self._get_json(args['ops'], out)
+        if ops is None:
+            return
+        if isinstance(ops, dict):
+            ops = [ops]
+        if not len(ops):
+            out('{"ok": 0, "err": "ops is empty"}')
+            return
+
+        if "ordered" not in args or flag(args, "ordered"):
+            bulk = conn[db][collection].initialize_ordered_bulk_op()
+        else:
+            bulk = conn[db][collection].initialize_unordered_bulk_op()
+
+        for i, op in enumerate(ops):
+            if not isinstance(op, dict) or len(op) != 1 or not isinstance(op.values()[0], dict):
+                out('{"ok": 0, "err": "invalid operation at index %d"}' % i)
+                return
+
+            (op_type, spec) = op.items()[0]
+            try:
+                if op_type == "insertOne":
+                    bulk.insert(spec['document'])
+                    continue
+
+                view = bulk.find(spec['filter'])
+                if spec.get('upsert') and op_type in ("updateOne", "updateMany", "replaceOne"):
+                    view = view.upsert()
+
+                if op_type == "updateOne":
+                    view.update_one(spec['update'])
+                elif op_type == "updateMany":
+                    view.update(spec['update'])
+                elif op_type == "replaceOne":
+                    view.replace_one(spec['replacement'])
+                elif op_type == "deleteOne":
+                    view.remove_one()
+                elif op_type == "deleteMany":
+                    view.remove()
+                else:
+                    out('{"ok": 0, "err": "unknown operation at index %d: %s"}' % (i, esc(op_type)))
+                    return
+            except KeyError, e:
+                out('{"ok": 0, "err": "missing %s at index %d"}' % (esc(e.args[0]), i))
+                return
+            except Exception, e:
+                out('{"ok": 0, "err": "invalid %s at index %d: %s"}' % (esc(op_type), i, esc(e.message)))
+                return
+
+        write_concern = self.__write_concern(args, out)
+        if write_concern is None:
+            return
+
+        try:
+            with metrics.phase("mongo"):
+                result = bulk.execute(write_concern)
+        except BulkWriteError, bwe:
+            result = bwe.details
+        except Exception, e:
+            out('{"ok": 0, "err": "%s"}' % esc(e.message))
+            return
+        finally:
+            self.__invalidate(name, db, collection)
+
+        if result is None:
+            # w=0, nothing to report
+            out('{"ok": 1}')
+            return
+
+        summary = {"ok": 1,
+                   "nInserted": result['nInserted'],
+                   "nMatched": result['nMatched'],
+                   "nModified": result.get('nModified'),
+                   "nUpserted": result['nUpserted'],
+                   "nRemoved": result['nRemoved'],
+                   "writeErrors": [{"index": e['index'], "code": e['code'], "errmsg": e['errmsg']}
+                                   for e in result['writeErrors']]}
+        if result['writeConcernErrors']:
+            summary['writeConcernErrors'] = result['writeConcernErrors']
+
+        out(codec.dumps(summary))
+
+    def _import(self, args, out, name=None, db=None, collection=None):
+        """
+        insert the documents of an application/x-ndjson request body, one per line
+
+        the body is read and inserted a chunk at a time, the output has the
+        progress after each chunk and the lines which couldn't be inserted
+        """
+        if BulkWriteError is None:
+            out('{"ok": 0, "err": "bulk operations need pymongo 2.7 or later"}')
+            return
+
+        conn = self._get_connection(name)
+        if conn is None:
+            out('{"ok": 0, "err": "couldn\'t get connection to mongo"}')
+            return
+
+        if db is None or collection is None:
+            out('{"ok": 0, "err": "db and collection must be defined"}')
+            return
+
+        body = args.get('_body')
+        if body is None:
+            out('{"ok": 0, "err": "missing application/x-ndjson request body"}')
+            return
+        if isinstance(body, basestring):
+            body = StringIO(body)
+
+        result = {"lines": 0, "nInserted": 0, "nErrors": 0, "errors": []}
+
+        def error(line, err):
+            result['nErrors'] += 1
+            if len(result['errors']) < MongoHandler.import_max_errors:
+                result['errors'].append({"line": line, "err": err})
+
+        out('{"progress": [')
+        chunks = 0
+        chunk = []
+        size = 0
+        try:
+            while True:
+                line = body.readline(MongoHandler.import_max_line)
+                if line:
+                    result['lines'] += 1
+                    doc = self.__import_line(line, result['lines'], body, error)
+                    if doc is not None:
+                        chunk.append((result['lines'], doc))
+                        size += len(line)
+
+                if len(chunk) and (not line or size >= MongoHandler.import_chunk_size):
+                    result['nInserted'] += self.__import_chunk(conn[db][collection], chunk, error)
+                    if chunks > 0:
+                        out(',')
+                    chunks += 1
+                    out(codec.dumps({"lines": result['lines'], "nInserted": result['nInserted'],
+                                     "nErrors": result['nErrors']}))
+                    chunk = []
+                    size = 0
+
+                if not line:
+                    break
+        except Exception, e:
+            result['ok'] = 0
+            result['err'] = str(e)
+        else:
+            result['ok'] = 1
+        finally:
+            self.__invalidate(name, db, collection)
+
+        out('], ' + codec.dumps(result)[1:])
+
+    def __import_line(self, line, number, body, error):
+        """
+        the document of a line of an _import body, None if it's empty or invalid
+        """
+        if not line.endswith("\n") and len(line) >= MongoHandler.import_max_line:
+            # Skip the rest of the line
+            while line and not line.endswith("\n"):
+                line = body.readline(MongoHandler.import_max_line)
+            error(number, "line is longer than %d bytes" % MongoHandler.import_max_line)
+            return None
+
+        line = line.strip()
+        if not line:
+            return None
+
+        try:
+            doc = codec.loads(line)
+        except (ValueError, TypeError):
+            error(number, "couldn't parse JSON")
+            return None
+
+        if not isinstance(doc, dict):
+            error(number, "not a document")
+            return None
+        return doc
+
+    # noinspection PyMethodMayBeStatic
+    def __import_chunk(self, collection, chunk, error):
+        """
+        insert the (line number, document) pairs of chunk, returns the number of inserted documents
+        """
+        bulk = collection.initialize_unordered_bulk_op()
+        for number, doc in chunk:
+            bulk.insert(doc)
+
+        try:
+            with metrics.phase("mongo"):
+                result = bulk.execute({"w": 1})
+        except BulkWriteError, bwe:
+            result = bwe.details
+            for e in result['writeErrors']:
+                error(chunk[e['index']][0], e['errmsg'])
+        return result['nInserted']
 
     # noinspection PyUnusedLocal
     def _batch(self, args, out, name=None, db=None, collection=None):
         """
         batch process commands
+
+        with ordered=0 the commands run in parallel, their results are still
+        output in the order of the commands
         """
         requests = self._get_json(args['requests'], out)
         if requests is None:
             return
 
-        out("[")
-
-        first = True
+        tasks = []
         for request in requests:
             if "cmd" not in request:
                 continue
 
             cmd = request['cmd']
-            method = "GET"
-            if 'method' in request:
-                method = request['method']
 
             db = None
             if 'db' in request:
@@ -483,26 +1516,157 @@ class MongoHandler:
             if 'collection' in request:
                 collection = request['collection']
 
-            args = {}
+            args_ = {}
             name = None
             if 'args' in request:
-                args = request['args']
-                if 'name' in args:
-                    name = args['name']
+                args_ = request['args']
+                if 'name' in args_:
+                    name = args_['name']
 
             func = getattr(MongoHandler.mh, cmd, None)
             if callable(func):
-                output = MongoFakeStream()
-                func(args, output.ostream, name=name, db=db, collection=collection)
-                if not first:
+                tasks.append(BatchTask(func, args_, name, db, collection))
+
+        tasks = self.__coalesce_inserts(tasks)
+
+        out("[")
+
+        if self.batch_pool is None or 'ordered' not in args or flag(args, 'ordered'):
+            # One after the other, each result is written as it is produced
+            for i, task in enumerate(tasks):
+                if i > 0:
                     out(",")
-                first = False
+                task.run(out)
+        else:
+            for task in tasks:
+                try:
+                    self.batch_pool.submit(task.run)
+                except Queue.Full:
+                    # The rest is run by this thread below
+                    break
+
+            for i, task in enumerate(tasks):
+                # Run it here if no worker has started it yet, wait for it otherwise
+                task.run()
+                task.done.wait()
+                if i > 0:
+                    out(",")
+                out("".join(task.output))
+
+        out("]")
+
+    def __coalesce_inserts(self, tasks):
+        """
+        Merge the runs of _insert commands on the same collection into one bulk insert
+        """
+        if BulkWriteError is None:
+            return tasks
 
-                out(output.get_ostream())
+        merged = []
+        for task in tasks:
+            if task.func != self._insert or task.db is None or task.collection is None or 'docs' not in task.args:
+                merged.append(task)
+                continue
+
+            # Like a separate _insert, it goes to the write-behind buffer
+            if self.__write_behind_for(task.args, task.db, task.collection):
+                merged.append(task)
+                continue
+
+            # Only inserts with the same write concern are merged, an invalid one is left to _insert
+            write_concern = self.__write_concern(task.args, MongoFakeStream().ostream)
+            if write_concern is None:
+                merged.append(task)
+                continue
+
+            if len(merged) and merged[-1].func == self.__insert_run and \
+                    (merged[-1].name, merged[-1].db, merged[-1].collection) == (task.name, task.db, task.collection) \
+                    and merged[-1].args['write_concern'] == write_concern:
+                merged[-1].args['commands'].append(task)
             else:
+                merged.append(BatchTask(self.__insert_run, {'commands': [task], 'write_concern': write_concern},
+                                        task.name, task.db, task.collection))
+
+        # A lone _insert stays as it is
+        return [t.args['commands'][0] if t.func == self.__insert_run and len(t.args['commands']) == 1 else t
+                for t in merged]
+
+    def __insert_run(self, args, out, name=None, db=None, collection=None):
+        """
+        Insert the docs of several _insert commands with as few bulk inserts as possible,
+        outputs one result per command like _insert would
+        """
+        commands = args['commands']
+        write_concern = args['write_concern']
+
+        conn = self._get_connection(name)
+        if conn is None:
+            out(",".join(['{"ok": 0, "err": "couldn\'t get connection to mongo"}'] * len(commands)))
+            return
+
+        results = [None] * len(commands)
+        oids = [[] for command in commands]
+
+        # (command index, doc) pairs
+        ops = []
+        for i, command in enumerate(commands):
+            output = MongoFakeStream()
+            docs = self._get_json(command.args['docs'], output.ostream)
+            if docs is None:
+                results[i] = output.get_ostream()
                 continue
 
-        out("]")
+            if isinstance(docs, dict):
+                docs = [docs]
+            if not isinstance(docs, list) or not all(isinstance(doc, dict) for doc in docs):
+                results[i] = '{"ok": 0, "err": "docs must be documents"}'
+                continue
+
+            for doc in docs:
+                if '_id' not in doc:
+                    doc['_id'] = ObjectId()
+                oids[i].append(doc['_id'])
+                ops.append((i, doc))
+
+        start = 0
+        while start < len(ops):
+            bulk = conn[db][collection].initialize_ordered_bulk_op()
+            for i, doc in ops[start:]:
+                bulk.insert(doc)
+
+            try:
+                with metrics.phase("mongo"):
+                    bulk.execute(write_concern)
+                break
+            except BulkWriteError, bwe:
+                if not bwe.details['writeErrors']:
+                    break
+                error = bwe.details['writeErrors'][0]
+                failed = ops[start + error['index']][0]
+                results[failed] = codec.dumps({"ok": 1, "err": error['errmsg'], "code": error['code'], "n": 0})
+
+                # Like a separate insert, the failed command stops, the next ones go on
+                start += error['index'] + 1
+                while start < len(ops) and ops[start][0] == failed:
+                    start += 1
+            except Exception, e:
+                for i, doc in ops[start:]:
+                    if results[i] is None:
+                        results[i] = '{"ok": 0, "err": "%s"}' % esc(e.message)
+                break
+
+        self.__invalidate(name, db, collection)
+
+        # What _insert outputs for each command
+        status = {"ok": 1}
+        if write_concern['w'] != 0:
+            status.update({"err": None, "n": 0})
+        for i, result in enumerate(results):
+            if result is None:
+                status['oids'] = oids[i]
+                results[i] = codec.dumps(status)
+
+        out(",".join(results))
 
     def _ensure_index(self, args, out, name=None, db=None, collection=None):
         """
@@ -533,18 +1697,132 @@ class MongoHandler:
             cache_for = args['cache_for']
 
         try:
-            name = conn[db][collection].ensure_index(keys.items(), cache_for=cache_for,  **options)
-            out('{"ok": 1, "name": "%s"}' % name)
+            index_name = conn[db][collection].ensure_index(keys.items(), cache_for=cache_for,  **options)
+            self.__flush_indexes(name, db, collection)
+            out('{"ok": 1, "name": "%s"}' % index_name)
         except Exception, e:
             out('{"ok": 0, "err": "%s"}' % esc(e.message))
 
+    # noinspection PyUnusedLocal
+    def _flush_index_cache(self, args, out, name=None, db=None, collection=None):
+        """
+        Forget the cached indexes of a collection, a db (/db/_flush_index_cache) or of
+        every db (/_flush_index_cache)
+        """
+        if db == "admin" and collection is None:
+            db = None
+
+        out('{"ok": 1, "flushed": %d}' % self.__flush_indexes(name, db, collection))
+
+    def __unique_keys(self, name, collection):
+        """
+        The keys of the _id and the unique indexes of a collection
+        """
+        if name is None:
+            name = "default"
+        cache_key = (name, collection.database.name, collection.name)
+
+        if self.index_cache is not None:
+            unique_keys = self.index_cache.get(cache_key)
+            if unique_keys is not None:
+                return unique_keys
+
+        with metrics.phase("index_information"):
+            ii = collection.index_information()
+        unique_keys = [[k for k in dict(o['key'])] for (ik, o) in ii.items()
+                       if ik == '_id_' or 'unique' in o and o['unique']]
+
+        # A collection without an _id index doesn't exist yet, it will have one soon
+        if self.index_cache is not None and '_id_' in ii:
+            self.index_cache.set(cache_key, unique_keys)
+
+        return unique_keys
+
+    def __flush_indexes(self, name=None, db=None, collection=None):
+        """
+        Forget the cached indexes of a collection, a db, or every db if db is None
+        """
+        if self.index_cache is None:
+            return 0
+
+        if name is None:
+            name = "default"
+
+        if db is None:
+            return self.index_cache.remove_if(lambda key: key[0] == name)
+        elif collection is None:
+            return self.index_cache.remove_if(lambda key: key[:2] == (name, db))
+        else:
+            return self.index_cache.remove_if(lambda key: key == (name, db, collection))
+
+
+class BsonOut:
+    """
+    Output of a handler in BSON, the JSON it writes is converted
+    """
+
+    def __init__(self, out):
+        self.out = out
+
+    def __call__(self, s):
+        try:
+            obj = codec.loads(s)
+        except (ValueError, TypeError):
+            obj = {"ok": 0, "err": s}
+        self.out(BSON.encode(obj))
+
+    def raw(self, data):
+        """
+        write data, already BSON
+        """
+        self.out(data)
+
+
+class BatchTask:
+    """
+    A command of a _batch, run by the first thread which gets to it
+    """
+
+    def __init__(self, func, args, name, db, collection):
+        self.func = func
+        self.args = args
+        self.name = name
+        self.db = db
+        self.collection = collection
+
+        self.output = []
+        self.started = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def run(self, out=None):
+        """
+        run the command unless it was started already, its output goes to out
+        or is collected in self.output
+        """
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+
+        try:
+            if out is not None:
+                self.func(self.args, out, name=self.name, db=self.db, collection=self.collection)
+            else:
+                try:
+                    self.func(self.args, self.output.append, name=self.name, db=self.db, collection=self.collection)
+                except Exception, e:
+                    self.output = ['{"ok": 0, "err": "%s"}' % esc(e)]
+        finally:
+            self.done.set()
+
 
 class MongoFakeStream:
     def __init__(self):
-        self.str = ""
+        self.chunks = []
 
     def ostream(self, content):
-        self.str = self.str + content
+        self.chunks.append(content)
 
     def get_ostream(self):
-        return self.str
+        return "".join(self.chunks)
@@ -17,7 +17,13 @@
 from SocketServer import BaseServer
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
-from handlers import MongoHandler
+from handlers import MongoHandler, flag
+import codec
+import compression
+import metrics
+from pool import WorkerPool
+from slowlog import SlowLog
+from static import StaticFiles
 
 try:
     from OpenSSL import SSL
@@ -25,12 +31,19 @@ except ImportError:
     SSL = None
     pass
 
+import mmap
+import os
 import os.path
+import select
+import signal
 import socket
+import time
+import urllib
 import urlparse
 import cgi
 import getopt
 import sys
+import Queue
 
 try:
     import json
@@ -62,6 +75,128 @@ class HTTPSServer(HTTPServer):
         self.server_activate()
 
 
+class ThreadPoolMixIn:
+    """
+    Handle each request on a bounded pool of worker threads
+    """
+    threads = 0
+    queue_size = 64
+
+    pool = None
+
+    def process_request(self, request, client_address):
+        if self.pool is None:
+            self.pool = WorkerPool(ThreadPoolMixIn.threads, ThreadPoolMixIn.queue_size, name="httpd")
+
+        try:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        except Queue.Full:
+            # Every worker is busy and the queue is full, don't let the backlog grow
+            try:
+                request.sendall("HTTP/1.0 503 Service Unavailable\r\n"
+                                "Content-Type: application/json\r\n\r\n"
+                                '{"ok": 0, "err": "server is busy"}')
+            except (socket.error, IOError):
+                pass
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        HTTPServer.server_close(self)
+
+
+class ThreadedHTTPServer(ThreadPoolMixIn, HTTPServer):
+    pass
+
+
+class ThreadedHTTPSServer(ThreadPoolMixIn, HTTPSServer):
+    pass
+
+
+class RequestBody:
+    """
+    A request body read from the connection as the handler consumes it,
+    delimited by Content-Length or by chunked transfer encoding
+    """
+
+    def __init__(self, rfile, length=0, chunked=False):
+        self.rfile = rfile
+        self.chunked = chunked
+        # Bytes left in the body, or in the current chunk
+        self.remaining = length
+        self.chunks = 0
+        self.done = not chunked and length <= 0
+
+    def _next_chunk(self):
+        if self.chunks > 0:
+            # The CRLF after the previous chunk
+            self.rfile.readline(2)
+        self.chunks += 1
+
+        self.remaining = int(self.rfile.readline(1024).split(';')[0].strip(), 16)
+        if self.remaining == 0:
+            # Skip the trailers
+            while self.rfile.readline(65536).strip():
+                pass
+            self.done = True
+
+    def readline(self, limit=-1):
+        """
+        the next line, at most limit bytes of it, "" at the end of the body
+        """
+        parts = []
+        size = 0
+        while not self.done and (limit < 0 or size < limit):
+            if self.remaining <= 0:
+                self._next_chunk()
+                continue
+
+            if limit < 0:
+                part = self.rfile.readline(self.remaining)
+            else:
+                part = self.rfile.readline(min(self.remaining, limit - size))
+            if not part:
+                # The client went away
+                self.done = True
+                break
+
+            self.remaining -= len(part)
+            if self.remaining <= 0 and not self.chunked:
+                self.done = True
+
+            parts.append(part)
+            size += len(part)
+            if part.endswith("\n"):
+                break
+
+        return "".join(parts)
+
+    def __iter__(self):
+        return iter(lambda: self.readline(65536), "")
+
+    def drain(self):
+        """
+        read what the handler left of the body, so that the connection can be reused,
+        returns False if the body is broken
+        """
+        try:
+            for line in self:
+                pass
+        except (ValueError, socket.error):
+            self.done = True
+            return False
+        return True
+
+
 class MongoHTTPRequest(BaseHTTPRequestHandler):
     mimetypes = {"html": "text/html",
                  "htm": "text/html",
@@ -79,8 +214,55 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
     mongos = []
     response_headers = []
     jsonp_callback = None
+    body = None
+
+    # Of the current request, for the metrics
+    status_code = 0
+    bytes_out = 0
+    labels = ("static", None, None)
+    args = None
+
+    # Requests of at least slow_ms milliseconds are logged to slow_log_path,
+    # if it is set
+    slow_log_path = None
+    slow_ms = 100
+    slow_log = None
+
+    # Bodies of these types aren't parsed as a form, the handler gets them
+    # as args['_body'] and reads them line by line
+    stream_types = ("application/x-ndjson", "application/ndjson")
+    engine = "sync"
+    workers = 0
+
+    # Persistent connections, a connection is closed after keepalive_timeout
+    # idle seconds or max_requests requests (0 = no limit). They need worker
+    # threads or the async engine, an idle connection holds its thread
+    protocol_version = "HTTP/1.1"
+    keepalive_timeout = 15
+    max_requests = 100
+    last_request = False
+
+    # Send the headers and the body in one go
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    # Responses of at least compress_min_size bytes are gzip or deflate
+    # encoded if the client accepts it (compress_level = 0 disables it),
+    # streamed responses are always encoded
+    compress_min_size = 1024
+    compress_level = 6
+    compressor = None
+
+    # Files of the docroot of at most static_max_file_size bytes are cached,
+    # the static_cache_files most recently used ones (0 = no caching)
+    static_cache_files = 256
+    static_max_file_size = 65536
+    static_files = None
+    # Bytes of a large file sent at once
+    static_block_size = 262144
 
-    def _parse_call(self, uri):
+    @staticmethod
+    def _parse_call(uri):
         """ 
         this turns a uri like: /foo/bar/_query into properties: using the db 
         foo, the collection bar, executing a query.
@@ -100,11 +282,133 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
         else:
             return parts[0], ".".join(parts[1:-1]), parts[-1]
 
+    def handle(self):
+        """
+        handle requests until the client closes the connection, it is idle
+        for too long or it has made max_requests requests
+        """
+        requests = 0
+        self.close_connection = 0
+
+        while not self.close_connection:
+            if requests > 0 and not self.wait_for_request():
+                break
+
+            requests += 1
+            self.last_request = (MongoHTTPRequest.keepalive_timeout <= 0 or
+                                 0 < MongoHTTPRequest.max_requests <= requests)
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """
+        wait at most keepalive_timeout seconds for the next request
+        """
+        # A pipelined request may already be buffered
+        # noinspection PyProtectedMember
+        if self.rfile._rbuf.tell() > 0:
+            return True
+        if hasattr(self.request, 'pending') and self.request.pending() > 0:
+            return True
+
+        try:
+            r, w, x = select.select([self.request], [], [], MongoHTTPRequest.keepalive_timeout)
+        except (select.error, socket.error):
+            return False
+        return len(r) > 0
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        if self.last_request or self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'keep-alive')
+
+    def content_coding(self, content_type):
+        """
+        the coding the response should use, None for none
+        """
+        if MongoHTTPRequest.compress_level <= 0 or not compression.compressible(content_type):
+            return None
+        return compression.negotiate(self.headers.get('Accept-Encoding'))
+
+    def send_coding_headers(self, content_type, coding):
+        if coding is not None:
+            self.send_header('Content-Encoding', coding)
+        if MongoHTTPRequest.compress_level > 0 and compression.compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+
+    def send_content(self, content, content_type):
+        """
+        send a complete 200 response
+        """
+        coding = None
+        if len(content) >= MongoHTTPRequest.compress_min_size:
+            coding = self.content_coding(content_type)
+        if coding is not None:
+            content = compression.compress(content, coding, MongoHTTPRequest.compress_level)
+
+        self.send_response(200, 'OK')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_coding_headers(content_type, coding)
+        for header in self.response_headers:
+            self.send_header(header[0], header[1])
+        self.end_headers()
+        self.wfile.write(content)
+        self.bytes_out += len(content)
+
+    def start_chunked(self, content_type, headers=()):
+        """
+        start a 200 response whose length isn't known in advance
+        """
+        coding = self.content_coding(content_type)
+        self.compressor = None
+        if coding is not None:
+            self.compressor = compression.compressor(coding, MongoHTTPRequest.compress_level)
+
+        if self.request_version < 'HTTP/1.1':
+            # HTTP/1.0 has no chunks, the end of the body is the end of the connection
+            self.close_connection = 1
+
+        self.send_response(200, 'OK')
+        self.send_header('Content-type', content_type)
+        if self.request_version >= 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_coding_headers(content_type, coding)
+        for header in headers:
+            self.send_header(header[0], header[1])
+        for header in self.response_headers:
+            self.send_header(header[0], header[1])
+        self.end_headers()
+
+    def write_chunk(self, data):
+        if self.compressor is not None and data:
+            data = self.compressor.compress(data)
+        self._write_chunk(data)
+
+    def _write_chunk(self, data):
+        if not data:
+            return
+        self.bytes_out += len(data)
+        if self.request_version >= 'HTTP/1.1':
+            self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def end_chunked(self):
+        if self.compressor is not None:
+            self._write_chunk(self.compressor.flush())
+            self.compressor = None
+        if self.request_version >= 'HTTP/1.1':
+            self.wfile.write("0\r\n\r\n")
+
     def call_handler(self, uri, args):
         """ execute something """
 
         (db, collection, func_name) = self._parse_call(uri)
         if db is None or func_name is None:
+            self.labels = ("unknown", None, None)
             self.send_error(404, 'Script Not Found: ' + uri)
             return
 
@@ -114,34 +418,58 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
 
         self.jsonp_callback = None
         if "callback" in args:
-            if type(args).__name__ == "dict":
-                self.jsonp_callback = args["callback"][0]
-            else:
-                self.jsonp_callback = args.getvalue("callback")
+            self.jsonp_callback = args["callback"]
+
+        self.args = args
+
+        if func_name in MongoHandler.bson_handlers and 'format' not in args and \
+                MongoHandler.bson_type in self.headers.get('Accept', ""):
+            args['format'] = "bson"
 
         func = getattr(MongoHandler.mh, func_name, None)
         if callable(func):
-            self.send_response(200, 'OK')
-            self.send_header('Content-type', MongoHTTPRequest.mimetypes['json'])
-            for header in self.response_headers:
-                self.send_header(header[0], header[1])
-            self.end_headers()
+            self.labels = (func_name, db, collection)
+            (content_type, stream) = MongoHandler.mh.response_type(func_name, args)
+            if content_type is not None:
+                # JSONP only wraps JSON
+                self.jsonp_callback = None
+            else:
+                content_type = MongoHTTPRequest.mimetypes['json']
+
+        if callable(func) and stream:
+            # The output is sent as the handler writes it
+            self.start_chunked(content_type)
+            try:
+                if self.jsonp_callback:
+                    self.write_chunk('%s(' % self.jsonp_callback)
+                func(args, self.write_chunk, name=name, db=db, collection=collection)
+                if self.jsonp_callback:
+                    self.write_chunk(')')
+                self.end_chunked()
+            except socket.error:
+                # The client went away
+                self.close_connection = 1
+            return
+        elif callable(func):
+            # The output is collected first, so that its length can be sent
+            output = []
+            func(args, output.append, name=name, db=db, collection=collection)
+            output = "".join(output)
 
             if self.jsonp_callback:
-                func(args, self.prependJSONPCallback, name=name, db=db, collection=collection)
-            else:
-                func(args, self.wfile.write, name=name, db=db, collection=collection)
+                output = self.prependJSONPCallback(output)
 
+            with metrics.phase("send"):
+                self.send_content(output, content_type)
             return
         else:
+            self.labels = ("unknown", None, None)
             self.send_error(404, 'Script Not Found: ' + uri)
             return
 
     def prependJSONPCallback(self, s):
-        jsonp_output = '%s(' % self.jsonp_callback + s + ')'
-        self.wfile.write(jsonp_output)
+        return '%s(' % self.jsonp_callback + s + ')'
 
-    # TODO: check for ..s
     def process_uri(self, method):
         # Parse GET parameters
         (uri, q, args) = self.path.partition('?')
@@ -150,8 +478,36 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
         else:
             args = {}
 
+        self.body = None
         if method == "POST":
-            if 'Content-Type' in self.headers:
+            content_type = self.headers.get('Content-Type', "").split(';')[0].strip().lower()
+            if content_type in MongoHTTPRequest.stream_types:
+                if self.headers.get('Expect', "").lower() == "100-continue":
+                    self.wfile.write("%s 100 Continue\r\n\r\n" % self.protocol_version)
+                    self.wfile.flush()
+
+                chunked = self.headers.get('Transfer-Encoding', "").lower() == "chunked"
+                self.body = RequestBody(self.rfile, int(self.headers.get('Content-Length', 0) or 0), chunked)
+                args['_body'] = self.body
+            elif content_type == MongoHTTPRequest.mimetypes['json']:
+                # The body is the arguments object, decoded in one go
+                if self.headers.get('Transfer-Encoding', "").lower() == "chunked":
+                    body = "".join(RequestBody(self.rfile, chunked=True))
+                else:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+
+                try:
+                    pargs = codec.loads(body) if body.strip() else {}
+                except (ValueError, TypeError):
+                    pargs = None
+                if not isinstance(pargs, dict):
+                    self.send_content('{"ok": 0, "err": "the request body must be a JSON object"}',
+                                      MongoHTTPRequest.mimetypes['json'])
+                    return None, None, None
+
+                # POST arguments take precedence over the GET ones
+                args.update(pargs)
+            elif 'Content-Type' in self.headers:
                 pargs = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
                                          environ={'REQUEST_METHOD': 'POST',
                                                   'CONTENT_TYPE': self.headers['Content-Type']})
@@ -159,12 +515,18 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
                 for k in pargs.keys():
                     args[k] = pargs.getvalue(k)
             else:
+                # The body wasn't read, so the connection can't be reused
+                self.close_connection = 1
+                msg = '{"ok" : 0, "errmsg" : "100-continue msgs not handled yet"}'
+
                 self.send_response(100, "Continue")
                 self.send_header('Content-type', MongoHTTPRequest.mimetypes['json'])
+                self.send_header('Content-Length', str(len(msg)))
+                self.send_header('Connection', 'close')
                 for header in self.response_headers:
                     self.send_header(header[0], header[1])
                 self.end_headers()
-                self.wfile.write('{"ok" : 0, "errmsg" : "100-continue msgs not handled yet"}')
+                self.wfile.write(msg)
 
                 return None, None, None
 
@@ -181,38 +543,158 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
 
         return uri, args, t
 
+    def begin_request(self):
+        self.status_code = 500
+        self.bytes_out = 0
+        self.labels = ("static", None, None)
+        self.args = None
+        return metrics.registry.begin(int(self.headers.get('Content-Length', 0) or 0))
+
+    def end_request(self, start):
+        (elapsed, phases) = metrics.registry.end(start, self.labels[0], self.labels[1], self.labels[2],
+                                                 self.status_code, self.bytes_out)
+        if MongoHTTPRequest.slow_log is not None:
+            MongoHTTPRequest.slow_log.log(elapsed, self.labels[0], self.labels[1], self.labels[2],
+                                          self.status_code, phases, self.args)
+
     def do_GET(self):
-        (uri, args, t) = self.process_uri("GET")
+        start = self.begin_request()
+        try:
+            with metrics.phase("parse"):
+                (uri, args, t) = self.process_uri("GET")
 
-        # serve up a plain file
-        if len(t) != 0:
-            if t in MongoHTTPRequest.mimetypes and os.path.exists(MongoHTTPRequest.docroot + uri):
+            # serve up a plain file
+            if len(t) != 0:
+                if t in MongoHTTPRequest.mimetypes:
+                    self.send_file(uri, MongoHTTPRequest.mimetypes[t])
+                else:
+                    self.send_error(404, 'File Not Found: ' + uri)
+                return
 
-                fh = open(MongoHTTPRequest.docroot + uri, 'r')
+            self.call_handler(uri, args)
+        finally:
+            self.end_request(start)
 
-                self.send_response(200, 'OK')
-                self.send_header('Content-type', MongoHTTPRequest.mimetypes[t])
-                for header in self.response_headers:
-                    self.send_header(header[0], header[1])
-                self.end_headers()
-                self.wfile.write(fh.read())
+    def send_file(self, uri, content_type):
+        """
+        send a file of the docroot, answering conditional and range requests
+        """
+        f = MongoHTTPRequest.static_files.lookup(urllib.unquote(uri))
+        if f is None:
+            self.send_error(404, 'File Not Found: ' + uri)
+            return
+
+        headers = [('ETag', f.etag), ('Last-Modified', f.last_modified), ('Accept-Ranges', 'bytes')]
+
+        if f.not_modified(self.headers):
+            self.send_response(304, 'Not Modified')
+            self.send_headers(headers)
+            return
+
+        byte_range = f.byte_range(self.headers)
+        if byte_range is False:
+            self.send_response(416, 'Requested Range Not Satisfiable')
+            self.send_header('Content-Range', 'bytes */%d' % f.size)
+            self.send_header('Content-Length', '0')
+            self.send_headers(headers)
+            return
+
+        if byte_range is not None:
+            (start, end) = byte_range
+            self.send_response(206, 'Partial Content')
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, f.size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_headers(headers)
+            self.write_file(f, start, end - start + 1)
+            return
 
+        coding = None
+        if f.size >= MongoHTTPRequest.compress_min_size:
+            coding = self.content_coding(content_type)
+        if coding is not None:
+            # Each coding is a different representation
+            headers[0] = ('ETag', f.etag[:-1] + '-' + coding + '"')
+
+        if f.content is None and coding is not None:
+            # Too large to be compressed at once
+            self.start_chunked(content_type, headers)
+            fh = open(f.path, 'rb')
+            try:
+                for block in iter(lambda: fh.read(MongoHTTPRequest.static_block_size), ""):
+                    self.write_chunk(block)
+            finally:
                 fh.close()
+            self.end_chunked()
+            return
 
-                return
+        content = f.content
+        if content is not None and coding is not None:
+            content = f.encoded.get(coding)
+            if content is None:
+                content = f.encoded[coding] = compression.compress(f.content, coding,
+                                                                   MongoHTTPRequest.compress_level)
+
+        self.send_response(200, 'OK')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(f.size if content is None else len(content)))
+        self.send_coding_headers(content_type, coding)
+        self.send_headers(headers)
+        if content is None:
+            self.write_file(f, 0, f.size)
+        else:
+            self.wfile.write(content)
+            self.bytes_out += len(content)
 
-            else:
-                self.send_error(404, 'File Not Found: ' + uri)
+    def send_headers(self, headers):
+        """
+        send headers and the configured response headers, and end the headers
+        """
+        for header in headers:
+            self.send_header(header[0], header[1])
+        for header in self.response_headers:
+            self.send_header(header[0], header[1])
+        self.end_headers()
 
-                return
+    def write_file(self, f, start, length):
+        """
+        write length bytes of f from start, mapped in memory rather than read
+        """
+        if length <= 0:
+            return
 
-        self.call_handler(uri, args)
+        fh = open(f.path, 'rb')
+        try:
+            m = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+
+        try:
+            end = start + length
+            if m.size() < end:
+                # The file shrank since it was looked up, the response will be short
+                self.close_connection = 1
+                end = m.size()
+
+            for pos in xrange(start, end, MongoHTTPRequest.static_block_size):
+                self.wfile.write(m[pos:min(pos + MongoHTTPRequest.static_block_size, end)])
+            self.bytes_out += max(end - start, 0)
+        finally:
+            m.close()
 
     def do_POST(self):
-        (uri, args, t) = self.process_uri("POST")
-        if uri is None:
-            return
-        self.call_handler(uri, args)
+        start = self.begin_request()
+        try:
+            with metrics.phase("parse"):
+                (uri, args, t) = self.process_uri("POST")
+            if uri is None:
+                return
+            self.call_handler(uri, args)
+
+            if self.body is not None and not self.body.drain():
+                self.close_connection = 1
+        finally:
+            self.end_request(start)
 
     @staticmethod
     def serve_forever(host, port):
@@ -222,9 +704,30 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
         print "|      MongoDB HTTP Server      |"
         print "=================================\n"
 
+        if ThreadPoolMixIn.threads > 0:
+            server_class, secure_server_class = ThreadedHTTPServer, ThreadedHTTPSServer
+        else:
+            server_class, secure_server_class = HTTPServer, HTTPSServer
+
+        if MongoHTTPRequest.engine != "async" and ThreadPoolMixIn.threads <= 0 and \
+                MongoHTTPRequest.keepalive_timeout > 0:
+            # The only thread would wait on an idle connection while other clients can't connect
+            print "keep-alive needs worker threads (-t) or the async engine (-a), " \
+                  "connections are closed after each request\n"
+            MongoHTTPRequest.keepalive_timeout = 0
+
+        if MongoHTTPRequest.engine == "async" and HTTPSServer.pem is not None:
+            print "the async engine doesn't support secure connections yet\n"
+            return
+
         if HTTPSServer.pem is None:
             try:
-                server = HTTPServer((host, port), MongoHTTPRequest)
+                if MongoHTTPRequest.engine == "async":
+                    from asyncd import AsyncHTTPServer
+                    server = AsyncHTTPServer((host, port), MongoHTTPRequest,
+                                             ThreadPoolMixIn.threads, ThreadPoolMixIn.queue_size)
+                else:
+                    server = server_class((host, port), MongoHTTPRequest)
             except socket.error, (value, message):
                 if value == 98:
                     print "could not bind to localhost:%d... is sleepy.mongoose already running?\n" % port
@@ -233,21 +736,88 @@ class MongoHTTPRequest(BaseHTTPRequestHandler):
                 return
         else:
             print "--------Secure Connection--------\n"
-            server = HTTPSServer((host, port), MongoHTTPSRequest)
+            server = secure_server_class((host, port), MongoHTTPSRequest)
+
+        print "listening for connections on http://%s:%d\n" % (host, port)
+        if MongoHTTPRequest.engine == "async":
+            print "using the async engine\n"
+        if ThreadPoolMixIn.threads > 0:
+            print "using %d worker threads, max %d queued connections\n" % (ThreadPoolMixIn.threads,
+                                                                           ThreadPoolMixIn.queue_size)
+        if MongoHTTPRequest.workers > 0:
+            print "using %d worker processes\n" % MongoHTTPRequest.workers
+            if not MongoHTTPRequest.prefork(MongoHTTPRequest.workers):
+                print "\nShutting down the server..."
+                server.server_close()
+                print "\nGood bye!\n"
+                return
 
+        # Connect after forking, mongo connections can't be shared between processes
         MongoHandler.mh = MongoHandler(MongoHTTPRequest.mongos)
+        MongoHTTPRequest.static_files = StaticFiles(MongoHTTPRequest.docroot, MongoHTTPRequest.static_cache_files,
+                                                    MongoHTTPRequest.static_max_file_size)
+        if MongoHTTPRequest.slow_log_path is not None:
+            path = MongoHTTPRequest.slow_log_path
+            if MongoHTTPRequest.workers > 0:
+                # One file per worker, they would rotate each other's
+                path = "%s.%d" % (path, os.getpid())
+            MongoHTTPRequest.slow_log = SlowLog(path, MongoHTTPRequest.slow_ms / 1000.0)
 
-        print "listening for connections on http://%s:%d\n" % (host, port)
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             pass
 
         print "\nShutting down the server..."
-        server.socket.close()
+        server.server_close()
+        MongoHandler.mh.close()
+        if MongoHTTPRequest.slow_log is not None:
+            MongoHTTPRequest.slow_log.close()
         print "\nGood bye!\n"
 
 
+    @staticmethod
+    def prefork(workers):
+        """
+        fork the worker processes, which all accept connections on the already
+        listening server socket, and restart the ones that die.
+
+        returns True in the workers, False in the master once it was stopped
+        """
+        children = set()
+
+        try:
+            while True:
+                while len(children) < workers:
+                    pid = os.fork()
+                    if pid == 0:
+                        return True
+                    children.add(pid)
+
+                pid, status = os.wait()
+                if pid in children:
+                    children.remove(pid)
+                    print "worker %d exited with status %d, restarting it" % (pid, status)
+                    # Don't fork in a tight loop if the workers die right after starting
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        return False
+
+
 class MongoHTTPSRequest(MongoHTTPRequest):
     def __init__(self, request, client_address, _server):
         self.connection = None
@@ -263,18 +833,51 @@ class MongoHTTPSRequest(MongoHTTPRequest):
 
 
 def usage():
-    print "python httpd.py [-x] [-d docroot/dir] [-s certificate.pem] [-m list,of,mongods] [-h host] [-p port]"
+    print "python httpd.py [-x] [-d docroot/dir] [-s certificate.pem] [-m list,of,mongods] [-h host] [-p port]" \
+          " [-t threads] [-q queue size] [-a] [-w workers] [-k keep-alive timeout] [--max-requests n]" \
+          " [--cursor-ttl seconds] [--max-cursors n] [--prefetch-threads n] [--prefetch-bytes n]" \
+          " [--query-cache n] [--query-cache-ttl seconds] [--count-cache n] [--count-cache-ttl seconds]" \
+          " [--index-cache-ttl seconds] [--codec json_util|fast]" \
+          " [--batch-threads n] [--import-chunk-size bytes] [--compress-min-size bytes] [--compress-level 0-9]" \
+          " [--static-cache n] [--slow-log file] [--slow-ms ms] [--write-behind db.collection,...]" \
+          " [--write-behind-docs n] [--write-behind-ms ms] [--metrics-namespaces n]"
     print "\t-x|--xorigin\tAllow cross-origin http requests"
     print "\t-d|--docroot\tlocation from which to load files"
     print "\t-s|--secure\tlocation of .pem file if ssl is desired"
     print "\t-m|--mongos\tcomma-separated list of mongo servers to connect to"
     print "\t-h|--host\tlistening host"
     print "\t-p|--port\tlistening port"
+    print "\t-t|--threads\tnumber of worker threads (0 = handle one request at a time)"
+    print "\t-q|--queue\tmax number of connections waiting for a worker thread"
+    print "\t-a|--async\tuse the event loop engine, mongo operations run on the -t worker threads"
+    print "\t-w|--workers\tnumber of pre-forked worker processes sharing the listening socket"
+    print "\t-k|--keepalive\tseconds to keep an idle connection open (0 = close after each request)," \
+          " needs -t or -a, an idle connection holds a worker thread"
+    print "\t--max-requests\tmax number of requests on one connection (0 = no limit)"
+    print "\t--cursor-ttl\tseconds after an unused cursor is closed (0 = never)"
+    print "\t--max-cursors\tmax number of open cursors, the least recently used is closed first (0 = no limit)"
+    print "\t--prefetch-threads\tthreads reading ahead the next batch for prefetch=1 requests (0 = disabled)"
+    print "\t--prefetch-bytes\tmax bytes read ahead per cursor"
+    print "\t--query-cache\tnumber of _find results to cache (0 = no caching)"
+    print "\t--query-cache-ttl\tseconds a cached _find result is used for"
+    print "\t--count-cache\tnumber of _count and _distinct results to cache (0 = no caching)"
+    print "\t--count-cache-ttl\tseconds a cached _count or _distinct result is used for"
+    print "\t--index-cache-ttl\tseconds the unique indexes of a collection are cached for upserts (0 = no caching)"
+    print "\t--codec\tJSON codec, json_util (default) or fast, both give the same output"
+    print "\t--batch-threads\tthreads running the commands of unordered (ordered=0) _batch requests"
+    print "\t--import-chunk-size\tbytes of documents _import inserts at once"
+    print "\t--compress-min-size\tsmallest response to gzip/deflate encode for clients accepting it"
+    print "\t--compress-level\tzlib compression level of responses (0 = no compression)"
+    print "\t--static-cache\tnumber of small docroot files kept in memory (0 = no caching)"
+    print "\t--slow-log\tfile to log the slow requests to, with their timing per phase"
+    print "\t--slow-ms\tmilliseconds from which a request is logged as slow"
+    print "\t--write-behind\tcomma-separated collections whose _inserts are buffered and inserted in bulk"
+    print "\t--write-behind-docs\tbuffered documents of a collection inserted at once"
+    print "\t--write-behind-ms\tmilliseconds a document waits in the buffer at most"
+    print "\t--metrics-namespaces\tdb/collection pairs labelled in _metrics, the others are counted as \"other\""
 
 
 def main():
-    import signal
-
     # Signal handling
     # noinspection PyUnusedLocal
     def signalHandler(sigNum, frame):
@@ -287,8 +890,16 @@ def main():
     signal.signal(signal.SIGABRT, signalHandler)
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "xd:s:m:h:p:", ["xorigin", "docroot=", "secure=", "mongos=",
-                                                                 "host=", "port=", "help"])
+        opts, args = getopt.getopt(sys.argv[1:], "xd:s:m:h:p:t:q:aw:k:",
+                                   ["xorigin", "docroot=", "secure=", "mongos=", "host=", "port=",
+                                    "threads=", "queue=", "async", "workers=", "keepalive=",
+                                    "max-requests=", "cursor-ttl=", "max-cursors=",
+                                    "prefetch-threads=", "prefetch-bytes=", "query-cache=",
+                                    "query-cache-ttl=", "count-cache=", "count-cache-ttl=",
+                                    "index-cache-ttl=", "codec=",
+                                    "batch-threads=", "import-chunk-size=", "compress-min-size=",
+                                    "compress-level=", "static-cache=", "slow-log=", "slow-ms=", "write-behind=",
+                                    "write-behind-docs=", "write-behind-ms=", "metrics-namespaces=", "help"])
         for o, a in opts:
             if o == "--help":
                 usage()
@@ -307,6 +918,62 @@ def main():
                 MongoHTTPRequest.host = a
             if o == "-p" or o == "--port":
                 MongoHTTPRequest.port = int(a)
+            if o == "-t" or o == "--threads":
+                ThreadPoolMixIn.threads = int(a)
+            if o == "-q" or o == "--queue":
+                ThreadPoolMixIn.queue_size = int(a)
+            if o == "-a" or o == "--async":
+                MongoHTTPRequest.engine = "async"
+            if o == "-w" or o == "--workers":
+                MongoHTTPRequest.workers = int(a)
+            if o == "-k" or o == "--keepalive":
+                MongoHTTPRequest.keepalive_timeout = float(a)
+            if o == "--max-requests":
+                MongoHTTPRequest.max_requests = int(a)
+            if o == "--cursor-ttl":
+                MongoHandler.cursor_ttl = float(a)
+            if o == "--max-cursors":
+                MongoHandler.max_cursors = int(a)
+            if o == "--prefetch-threads":
+                MongoHandler.prefetch_threads = int(a)
+            if o == "--prefetch-bytes":
+                MongoHandler.prefetch_max_bytes = int(a)
+            if o == "--query-cache":
+                MongoHandler.query_cache_size = int(a)
+            if o == "--query-cache-ttl":
+                MongoHandler.query_cache_ttl = float(a)
+            if o == "--count-cache":
+                MongoHandler.count_cache_size = int(a)
+            if o == "--count-cache-ttl":
+                MongoHandler.count_cache_ttl = float(a)
+            if o == "--index-cache-ttl":
+                MongoHandler.index_cache_ttl = float(a)
+            if o == "--codec":
+                if a not in codec.BACKENDS:
+                    raise getopt.GetoptError("unknown codec: %s" % a)
+                codec.use(a)
+            if o == "--batch-threads":
+                MongoHandler.batch_threads = int(a)
+            if o == "--import-chunk-size":
+                MongoHandler.import_chunk_size = int(a)
+            if o == "--compress-min-size":
+                MongoHTTPRequest.compress_min_size = int(a)
+            if o == "--compress-level":
+                MongoHTTPRequest.compress_level = min(int(a), 9)
+            if o == "--static-cache":
+                MongoHTTPRequest.static_cache_files = int(a)
+            if o == "--slow-log":
+                MongoHTTPRequest.slow_log_path = a
+            if o == "--slow-ms":
+                MongoHTTPRequest.slow_ms = float(a)
+            if o == "--write-behind":
+                MongoHandler.write_behind = a.split(',')
+            if o == "--write-behind-docs":
+                MongoHandler.write_behind_docs = int(a)
+            if o == "--write-behind-ms":
+                MongoHandler.write_behind_delay = float(a) / 1000
+            if o == "--metrics-namespaces":
+                metrics.registry.max_namespaces = int(a)
 
     except getopt.GetoptError:
         print "error parsing cmd line args."
@@ -0,0 +1,192 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request metrics, rendered in the Prometheus text format.
+
+The time a request spends in each phase (parsing, decoding JSON, waiting
+for mongo, encoding the response, ...) is added up in a thread local
+while it runs, by wrapping the phase in a `with phase("name"):` block.
+"""
+
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            phases[self.name] = phases.get(self.name, 0.0) + time.time() - self.start
+
+
+def phase(name):
+    """
+    a context manager adding the time spent in it to the phase name of the current request
+    """
+    return _Phase(name)
+
+
+def phases():
+    """
+    the phase times of the current request so far
+    """
+    return getattr(_local, 'phases', None) or {}
+
+
+class Histogram:
+    def __init__(self):
+        # Not cumulative, the last one counts the values above the last bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Latency histograms per handler, db, collection and status code, and
+    per handler and phase, in-flight requests and transferred bytes.
+
+    Only the first max_namespaces (db, collection) pairs get their own
+    labels, the requests to the others are counted as db="other", so that
+    made up URLs can't add series forever.
+    """
+
+    def __init__(self, max_namespaces=100):
+        self.lock = threading.Lock()
+        self.max_namespaces = max_namespaces
+        self.namespaces = set()
+        self.requests = {}
+        self.phases = {}
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def begin(self, bytes_in=0):
+        """
+        a request starts on this thread, returns its start time
+        """
+        _local.phases = {}
+        with self.lock:
+            self.in_flight += 1
+            self.bytes_in += bytes_in
+        return time.time()
+
+    def end(self, start, handler, db, collection, code, bytes_out=0):
+        """
+        the request started at start is done, returns its duration and phase times
+        """
+        elapsed = time.time() - start
+        request_phases = phases()
+        _local.phases = None
+
+        namespace = (db or "", collection or "")
+        with self.lock:
+            self.in_flight -= 1
+            self.bytes_out += bytes_out
+
+            if namespace not in self.namespaces:
+                if len(self.namespaces) < self.max_namespaces:
+                    self.namespaces.add(namespace)
+                else:
+                    namespace = ("other", "other")
+            key = (handler, namespace[0], namespace[1], str(code))
+
+            histogram = self.requests.get(key)
+            if histogram is None:
+                histogram = self.requests[key] = Histogram()
+            histogram.observe(elapsed)
+
+            for name, seconds in request_phases.iteritems():
+                histogram = self.phases.get((handler, name))
+                if histogram is None:
+                    histogram = self.phases[(handler, name)] = Histogram()
+                histogram.observe(seconds)
+
+        return elapsed, request_phases
+
+    def render(self, gauges=()):
+        """
+        the metrics in the Prometheus text format, with extra (name, help, value) gauges
+        """
+        with self.lock:
+            requests = [(k, list(h.counts), h.sum, h.count) for k, h in self.requests.iteritems()]
+            request_phases = [(k, list(h.counts), h.sum, h.count) for k, h in self.phases.iteritems()]
+            in_flight, bytes_in, bytes_out = self.in_flight, self.bytes_in, self.bytes_out
+
+        lines = []
+        _histogram(lines, "sleepymongoose_request_duration_seconds", "Time to handle a request",
+                   ("handler", "db", "collection", "code"), sorted(requests))
+        _histogram(lines, "sleepymongoose_phase_duration_seconds", "Time a request spent in a phase",
+                   ("handler", "phase"), sorted(request_phases))
+
+        _metric(lines, "sleepymongoose_requests_in_flight", "gauge", "Requests being handled", in_flight)
+        _metric(lines, "sleepymongoose_received_bytes_total", "counter", "Request body bytes received", bytes_in)
+        _metric(lines, "sleepymongoose_sent_bytes_total", "counter", "Response body bytes sent", bytes_out)
+        for name, help_text, value in gauges:
+            _metric(lines, name, "gauge", help_text, value)
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=""):
+    labels = ",".join(['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)])
+    if extra:
+        labels = labels + "," + extra if labels else extra
+    return "{%s}" % labels
+
+
+def _histogram(lines, name, help_text, label_names, histograms):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s histogram" % name)
+    for key, counts, total, count in histograms:
+        cumulative = 0
+        for le, n in zip(BUCKETS, counts):
+            cumulative += n
+            lines.append("%s_bucket%s %d" % (name, _labels(label_names, key, 'le="%r"' % le), cumulative))
+        lines.append("%s_bucket%s %d" % (name, _labels(label_names, key, 'le="+Inf"'), count))
+        lines.append("%s_sum%s %r" % (name, _labels(label_names, key), total))
+        lines.append("%s_count%s %d" % (name, _labels(label_names, key), count))
+
+
+def _metric(lines, name, metric_type, help_text, value):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s %s" % (name, metric_type))
+    lines.append("%s %r" % (name, value))
+
+
+registry = Metrics()
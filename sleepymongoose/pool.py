@@ -0,0 +1,62 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import traceback
+import Queue
+
+
+class WorkerPool:
+    """
+    A fixed set of daemon threads running callables from a bounded queue
+    """
+
+    def __init__(self, workers, queue_size=0, name="worker"):
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        queue func(*args, **kwargs), raises Queue.Full if the queue is full
+        """
+        self.queue.put_nowait((func, args, kwargs))
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+
+    def shutdown(self, wait=True):
+        """
+        stop the workers after the already queued tasks are done
+        """
+        for t in self.threads:
+            self.queue.put(None)
+
+        if wait:
+            for t in self.threads:
+                t.join()
@@ -0,0 +1,121 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import codec
+
+import logging
+import logging.handlers
+import threading
+import time
+import traceback
+import Queue
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Arguments holding JSON, logged with their values redacted
+JSON_ARGS = ("criteria", "fields", "sort", "newobj", "docs", "cmd", "ops", "keys", "options", "requests",
+             "pipeline")
+
+
+def shape(value):
+    """
+    value with every scalar replaced by "?", lists are reduced to the shape of their first item
+    """
+    if isinstance(value, dict):
+        return dict((k, shape(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [shape(v) for v in value[:1]]
+    return "?"
+
+
+def query_shape(args):
+    """
+    the arguments of a request with their values redacted
+    """
+    query = {}
+    for k, v in args.iteritems():
+        if k.startswith('_') or k == "callback":
+            continue
+        if k in JSON_ARGS and isinstance(v, basestring):
+            try:
+                v = codec.loads(v)
+            except (ValueError, TypeError):
+                pass
+        query[k] = shape(v)
+    return query
+
+
+class SlowLog:
+    """
+    Writes the requests slower than threshold seconds to a rotating file,
+    from a background thread. Entries are dropped if it can't keep up.
+    """
+
+    def __init__(self, path, threshold=0.1, max_bytes=10485760, backups=5, queue_size=1000):
+        self.threshold = threshold
+        self.dropped = 0
+
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._write, name="slowlog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, elapsed, handler, db, collection, code, phases, args):
+        """
+        queue the entry of a request if it took at least threshold seconds
+        """
+        if elapsed < self.threshold:
+            return
+
+        try:
+            self.queue.put_nowait((time.time(), elapsed, handler, db, collection, code, dict(phases),
+                                   dict(args or {})))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+
+            try:
+                self.handler.emit(logging.makeLogRecord({"msg": self._format(*entry)}))
+            except Exception:
+                traceback.print_exc()
+
+    # noinspection PyMethodMayBeStatic
+    def _format(self, when, elapsed, handler, db, collection, code, phases, args):
+        phases_ms = dict((k, round(v * 1000, 3)) for k, v in phases.iteritems())
+        phases_ms["other"] = round(max(elapsed - sum(phases.values()), 0) * 1000, 3)
+
+        return json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(when)) + "Z",
+                           "handler": handler,
+                           "db": db,
+                           "collection": collection,
+                           "code": code,
+                           "ms": round(elapsed * 1000, 3),
+                           "phases": phases_ms,
+                           "query": query_shape(args)}, sort_keys=True)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(5)
+        self.handler.close()
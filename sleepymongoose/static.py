@@ -0,0 +1,141 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cache import TTLCache
+
+import os
+import os.path
+import stat
+
+from email.utils import formatdate, mktime_tz, parsedate_tz
+
+
+class StaticFile:
+    """
+    A file of the docroot, with its content if it is small enough to be cached
+    """
+
+    def __init__(self, path, st, content=None):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.etag = '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+
+        self.content = content
+        # coding -> compressed content
+        self.encoded = {}
+
+    def matches(self, etag):
+        """
+        whether etag is the ETag of this file, in any coding
+        """
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        return etag == self.etag or etag.startswith(self.etag[:-1] + '-')
+
+    def not_modified(self, headers):
+        """
+        whether the client's copy is up to date, given the request headers
+        """
+        if 'If-None-Match' in headers:
+            tags = [tag.strip() for tag in headers['If-None-Match'].split(',')]
+            return '*' in tags or any(self.matches(tag) for tag in tags)
+
+        if 'If-Modified-Since' in headers:
+            since = parsedate_tz(headers['If-Modified-Since'])
+            return since is not None and int(self.mtime) <= mktime_tz(since)
+
+        return False
+
+    def byte_range(self, headers):
+        """
+        the (first, last) bytes requested with a Range header, None for the
+        whole file, False if the range can't be satisfied
+        """
+        value = headers.get('Range', "").strip()
+        # Multiple ranges aren't supported, the whole file is sent instead
+        if not value.startswith('bytes=') or ',' in value:
+            return None
+
+        if_range = headers.get('If-Range')
+        if if_range is not None and not self.matches(if_range.strip()) and if_range.strip() != self.last_modified:
+            return None
+
+        (start, dash, end) = value[6:].partition('-')
+        try:
+            if not start.strip():
+                # The last end bytes
+                start = self.size - int(end)
+                end = self.size - 1
+            else:
+                start = int(start)
+                end = int(end) if end.strip() else self.size - 1
+        except ValueError:
+            return None
+
+        if self.size == 0 or start >= self.size or end < max(start, 0):
+            return False
+        return max(start, 0), min(end, self.size - 1)
+
+
+class StaticFiles:
+    """
+    The files of the docroot. Files of at most max_file_size bytes are kept
+    in memory, the max_files most recently used of them, until they change.
+    """
+
+    def __init__(self, docroot, max_files=256, max_file_size=65536):
+        self.docroot = os.path.realpath(docroot)
+        self.max_file_size = max_file_size
+
+        self.cache = None
+        if max_files > 0:
+            # Entries are checked against the file on every lookup, they don't need to expire
+            self.cache = TTLCache(max_files, 86400)
+
+    def lookup(self, uri):
+        """
+        the StaticFile of uri, None if it isn't a file of the docroot
+        """
+        path = os.path.realpath(os.path.join(self.docroot, uri))
+        if not path.startswith(self.docroot + os.sep):
+            return None
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        if self.cache is None or st.st_size > self.max_file_size:
+            return StaticFile(path, st)
+
+        f = self.cache.get(path)
+        if f is not None and f.mtime == st.st_mtime and f.size == st.st_size:
+            return f
+
+        try:
+            fh = open(path, 'rb')
+            try:
+                content = fh.read()
+            finally:
+                fh.close()
+        except IOError:
+            return None
+
+        f = StaticFile(path, st, content)
+        self.cache.set(path, f)
+        return f
@@ -0,0 +1,161 @@
+# Copyright 2009-2015 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import traceback
+
+
+class WriteBehind:
+    """
+    Buffers the documents inserted into a collection, and inserts them in
+    one go once max_docs of them are waiting or the oldest one waited for
+    max_delay seconds, from a background thread.
+
+    At most max_buffered documents are kept in memory (being inserted
+    included), adding more waits until a flush made room.
+    """
+
+    def __init__(self, insert, max_docs=1000, max_delay=0.05, max_buffered=10000):
+        # insert(key, docs) inserts docs, returns the number of inserted ones
+        self.insert = insert
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+
+        self.cond = threading.Condition()
+        # key -> (time of the first doc, docs)
+        self.buffers = {}
+        self.buffered = 0
+        self.closed = False
+
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.failed = 0
+        self.last_error = None
+
+        self.thread = threading.Thread(target=self._flush, name="writebehind")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, key, docs, timeout=None):
+        """
+        buffer docs for the collection key, returns False if there wasn't room
+        for them within timeout seconds or if the buffer is closed
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.cond:
+            # More docs than max_buffered at once go in alone
+            while not self.closed and self.buffered and self.buffered + len(docs) > self.max_buffered:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+
+            if self.closed:
+                return False
+
+            buf = self.buffers.get(key)
+            if buf is None:
+                # A new window starts, the flusher must wake up at its end
+                buf = self.buffers[key] = (time.time(), [])
+                self.cond.notify_all()
+            buf[1].extend(docs)
+            self.buffered += len(docs)
+
+            if len(buf[1]) >= self.max_docs:
+                self.cond.notify_all()
+        return True
+
+    def _due(self, now):
+        """
+        the keys to flush now, and the time the next window ends (None = no buffered docs)
+        """
+        due = []
+        next_flush = None
+        for key, (first, docs) in self.buffers.iteritems():
+            end = first + self.max_delay
+            if self.closed or len(docs) >= self.max_docs or end <= now:
+                due.append(key)
+            elif next_flush is None or end < next_flush:
+                next_flush = end
+        return due, next_flush
+
+    def _flush(self):
+        while True:
+            with self.cond:
+                while True:
+                    due, next_flush = self._due(time.time())
+                    if due or (self.closed and not self.buffers):
+                        break
+                    if next_flush is None:
+                        self.cond.wait()
+                    else:
+                        self.cond.wait(max(next_flush - time.time(), 0.001))
+
+                if not due:
+                    return
+                batches = [(key, self.buffers.pop(key)[1]) for key in due]
+
+            for key, docs in batches:
+                self._insert(key, docs)
+
+            with self.cond:
+                self.buffered -= sum(len(docs) for key, docs in batches)
+                self.cond.notify_all()
+
+    def _insert(self, key, docs):
+        try:
+            inserted = self.insert(key, docs)
+            error = None
+        except Exception, e:
+            traceback.print_exc()
+            inserted = 0
+            error = str(e)
+
+        with self.cond:
+            self.flushes += 1
+            self.flushed += inserted
+            if inserted < len(docs):
+                self.failures += 1
+                self.failed += len(docs) - inserted
+                self.last_error = error or "%d of %d documents not inserted" % (len(docs) - inserted, len(docs))
+
+    def close(self, timeout=30):
+        """
+        insert what is still buffered and stop the background thread
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.cond:
+            return {"buffered": self.buffered,
+                    "max_buffered": self.max_buffered,
+                    "max_docs": self.max_docs,
+                    "max_delay": self.max_delay,
+                    "flushes": self.flushes,
+                    "flushed": self.flushed,
+                    "failures": self.failures,
+                    "failed": self.failed,
+                    "last_error": self.last_error}
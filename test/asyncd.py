@@ -0,0 +1,157 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sleepymongoose.asyncd import AsyncHTTPServer
+from sleepymongoose.httpd import MongoHTTPRequest
+from sleepymongoose.handlers import MongoHandler
+from sleepymongoose.static import StaticFiles
+
+PORT = 27090
+SIZE = 4194304
+
+
+class StubHandler:
+    """
+    Handlers answering without mongo
+    """
+
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def response_type(self, func_name, args):
+        return None, False
+
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def _big(self, args, out, name=None, db=None, collection=None):
+        out("x" * SIZE)
+
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def _small(self, args, out, name=None, db=None, collection=None):
+        out('{"ok": 1}')
+
+
+class TestAsyncServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mh = MongoHandler.mh
+        cls.keepalive_timeout = MongoHTTPRequest.keepalive_timeout
+        cls.static_files = MongoHTTPRequest.static_files
+
+        cls.docroot = tempfile.mkdtemp()
+        with open(os.path.join(cls.docroot, "index.html"), "w") as f:
+            f.write("<html>hello</html>")
+        with open(os.path.join(cls.docroot, "big.png"), "w") as f:
+            f.write("y" * SIZE)
+
+        MongoHandler.mh = StubHandler()
+        MongoHTTPRequest.keepalive_timeout = 1
+        MongoHTTPRequest.static_files = StaticFiles(cls.docroot)
+
+        cls.server = AsyncHTTPServer(("localhost", PORT), MongoHTTPRequest, 2, 10)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.server_close()
+        MongoHandler.mh = cls.mh
+        MongoHTTPRequest.keepalive_timeout = cls.keepalive_timeout
+        MongoHTTPRequest.static_files = cls.static_files
+        shutil.rmtree(cls.docroot)
+
+    def _connect(self, rcvbuf=None):
+        s = socket.socket()
+        if rcvbuf is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        s.connect(("localhost", PORT))
+        return s
+
+    def _get(self, path, headers=""):
+        s = self._connect()
+        try:
+            s.sendall("GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n%s\r\n" % (path, headers))
+            response = []
+            for data in iter(lambda: s.recv(65536), ""):
+                response.append(data)
+        finally:
+            s.close()
+        return "".join(response).partition("\r\n\r\n")[::2]
+
+    def test_slow_reader(self):
+        # Reading takes longer than the keep-alive timeout, the response must not be cut off
+        s = self._connect(4096)
+        try:
+            s.sendall("GET /_big HTTP/1.1\r\nHost: localhost\r\n\r\n")
+
+            response = []
+            received = 0
+            start = time.time()
+            while received <= SIZE:
+                data = s.recv(65536)
+                if not data:
+                    break
+                response.append(data)
+                received += len(data)
+                time.sleep(0.005)
+        finally:
+            s.close()
+
+        self.assertTrue(time.time() - start > 1)
+        self.assertTrue("".join(response).endswith("\r\n\r\n" + "x" * SIZE), "got %d bytes" % received)
+
+    def test_http10_keepalive(self):
+        s = self._connect()
+        try:
+            s.sendall("GET /_small HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+            time.sleep(0.2)
+            first = s.recv(65536)
+            s.sendall("GET /_small HTTP/1.0\r\n\r\n")
+            time.sleep(0.2)
+            second = s.recv(65536)
+        finally:
+            s.close()
+
+        self.assertTrue("\r\nConnection: keep-alive\r\n" in first.split("\r\n\r\n")[0] + "\r\n", first)
+        self.assertTrue(second.startswith("HTTP/1.1 200"), second)
+        self.assertTrue("\r\nConnection: close\r\n" in second.split("\r\n\r\n")[0] + "\r\n", second)
+
+    def test_static_file(self):
+        (head, body) = self._get("/")
+        self.assertTrue(head.startswith("HTTP/1.1 200"), head)
+        self.assertTrue("Content-Type: text/html" in head, head)
+        self.assertEqual(body, "<html>hello</html>")
+
+        etag = [line for line in head.split("\r\n") if line.startswith("ETag: ")][0][6:]
+        (head, body) = self._get("/index.html", "If-None-Match: %s\r\n" % etag)
+        self.assertTrue(head.startswith("HTTP/1.1 304"), head)
+        self.assertEqual(body, "")
+
+        (head, body) = self._get("/index.html", "Range: bytes=6-10\r\n")
+        self.assertTrue(head.startswith("HTTP/1.1 206"), head)
+        self.assertEqual(body, "hello")
+
+        (head, body) = self._get("/missing.html")
+        self.assertTrue(head.startswith("HTTP/1.1 404"), head)
+
+    def test_static_large_file(self):
+        # Not cached, read as it is sent
+        (head, body) = self._get("/big.png")
+        self.assertTrue(head.startswith("HTTP/1.1 200"), head)
+        self.assertTrue("Content-Length: %d" % SIZE in head, head)
+        self.assertEqual(body, "y" * SIZE)
+
+        (head, body) = self._get("/big.png", "Range: bytes=-3\r\n")
+        self.assertTrue(head.startswith("HTTP/1.1 206"), head)
+        self.assertEqual(body, "yyy")
+
+
+if __name__ == '__main__':
+    unittest.main()
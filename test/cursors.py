@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sleepymongoose.cursors import CursorRegistry
+
+
+class FakeCursor:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestCursorRegistry(unittest.TestCase):
+    def test_get_expired(self):
+        registry = CursorRegistry(ttl=0.05)
+        cursor = FakeCursor()
+        entry = registry.add(cursor, "test.mongoose")
+
+        self.assertTrue(registry.get(entry.id) is entry)
+
+        time.sleep(0.1)
+
+        self.assertEquals(registry.get(entry.id), None)
+        self.assertTrue(cursor.closed)
+        self.assertEquals(len(registry), 0)
+
+    def test_get_keeps_used(self):
+        registry = CursorRegistry(ttl=0.1)
+        entry = registry.add(FakeCursor(), "test.mongoose")
+
+        for i in range(4):
+            time.sleep(0.05)
+            self.assertTrue(registry.get(entry.id) is entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,16 @@
 # noinspection PyPackageRequirements
 from restclient import GET, POST
 
+# noinspection PyPackageRequirements
+from bson import BSON
+from cStringIO import StringIO
+
+import gzip
 import json
+import socket
+import time
 import unittest
+import urllib2
 
 
 class TestGET(unittest.TestCase):
@@ -59,6 +67,267 @@ class TestGET(unittest.TestCase):
         self.assertEquals(obj['results'][1]['x'], 2, s)
         self.assertEquals(obj['results'][2]['x'], 1, s)
 
+    def test_find_stream(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_find",
+                {"stream": "1", "batch_size": "2"})
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(len(obj['results']), 2, s)
+
+        s = GET("http://localhost:27080/test/mongoose/_more",
+                {"id": obj['id'], "stream": "1"})
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(len(obj['results']), 1, s)
+
+    def test_export(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_export",
+                {"sort": '{"x" : 1}', "batch_size": "2"})
+
+        lines = s.splitlines()
+
+        self.assertEquals(len(lines), 3, s)
+        self.assertEquals([json.loads(line)['x'] for line in lines], [1, 2, 3], s)
+
+    def test_export_csv(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1, "y" : {"z" : "a,b"}},{"x" : 2}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_export",
+                {"format": "csv", "fields": '["x", "y.z"]', "sort": '{"x" : 1}'})
+
+        self.assertEquals(s.splitlines(), ['x,y.z', '1,"a,b"', '2,'], s)
+
+    def test_export_bad_limit(self):
+        s = GET("http://localhost:27080/test/mongoose/_export",
+                {"limit": "ten"})
+
+        self.assertEquals(json.loads(s)['ok'], 0, s)
+
+    def test_idle_keepalive(self):
+        # A client keeping its connection open without sending anything
+        idle = socket.create_connection(("localhost", 27080))
+        try:
+            idle.sendall("GET /_hello HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            self.assertTrue(idle.recv(65536).startswith("HTTP/1.1 200"))
+
+            start = time.time()
+            s = urllib2.urlopen("http://localhost:27080/_hello", timeout=10).read()
+
+            self.assertEquals(json.loads(s)['ok'], 1, s)
+            self.assertTrue(time.time() - start < 2, "the idle connection held up another client")
+        finally:
+            idle.close()
+
+    def test_query_cache(self):
+        obj = json.loads(GET("http://localhost:27080/_status"))
+        if 'query_cache' not in obj:
+            self.skipTest("the server runs without --query-cache")
+
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2}]'},
+             async=False)
+
+        GET("http://localhost:27080/test/mongoose/_find")
+        hits = json.loads(GET("http://localhost:27080/_status"))['query_cache']['hits']
+
+        # Read only commands keep the cached results
+        POST("http://localhost:27080/test/_cmd",
+             params={'cmd': '{"count" : "mongoose"}'})
+        s = GET("http://localhost:27080/test/mongoose/_find")
+
+        self.assertEquals(len(json.loads(s)['results']), 2, s)
+        self.assertEquals(json.loads(GET("http://localhost:27080/_status"))['query_cache']['hits'], hits + 1)
+
+        # Writes don't
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 3}]'},
+             async=False)
+        s = GET("http://localhost:27080/test/mongoose/_find")
+
+        self.assertEquals(len(json.loads(s)['results']), 3, s)
+        self.assertEquals(json.loads(GET("http://localhost:27080/_status"))['query_cache']['hits'], hits + 1)
+
+        # The command is the first key, whatever the other ones are named
+        POST("http://localhost:27080/test/_cmd",
+             params={'cmd': '{"drop" : "mongoose", "explain" : false}'})
+        s = GET("http://localhost:27080/test/mongoose/_find")
+
+        self.assertEquals(len(json.loads(s)['results']), 0, s)
+        self.assertEquals(json.loads(GET("http://localhost:27080/_status"))['query_cache']['hits'], hits + 1)
+
+    def test_gzip(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': json.dumps([{"x": i, "padding": "x" * 100} for i in range(100)])},
+             async=False)
+
+        for stream in ("0", "1"):
+            request = urllib2.Request("http://localhost:27080/test/mongoose/_find?batch_size=100&stream=" + stream,
+                                      headers={"Accept-Encoding": "gzip"})
+            response = urllib2.urlopen(request)
+
+            self.assertEquals(response.info().get('Content-Encoding'), "gzip")
+
+            s = gzip.GzipFile(fileobj=StringIO(response.read())).read()
+            obj = json.loads(s)
+
+            self.assertEquals(obj['ok'], 1, s)
+            self.assertEquals(len(obj['results']), 100, s)
+
+    def test_find_bson(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        request = urllib2.Request("http://localhost:27080/test/mongoose/_find?batch_size=2",
+                                  headers={"Accept": "application/bson"})
+        response = urllib2.urlopen(request)
+
+        self.assertEquals(response.info().get('Content-Type'), "application/bson")
+
+        obj = BSON(response.read()).decode()
+
+        self.assertEquals(obj['ok'], 1)
+        self.assertEquals(len(obj['results']), 2)
+
+        s = GET("http://localhost:27080/test/mongoose/_more",
+                {"id": obj['id'], "format": "bson"})
+
+        obj = BSON(s).decode()
+
+        self.assertEquals(obj['ok'], 1)
+        self.assertEquals(len(obj['results']), 1)
+
+    def test_static(self):
+        response = urllib2.urlopen("http://localhost:27080/favicon.ico")
+        etag = response.info().get('ETag')
+        size = len(response.read())
+
+        self.assertEquals(response.info().get('Content-Type'), "image/vnd.microsoft.icon")
+        self.assertTrue(etag)
+
+        request = urllib2.Request("http://localhost:27080/favicon.ico", headers={"If-None-Match": etag})
+        try:
+            urllib2.urlopen(request)
+            self.fail("expected 304")
+        except urllib2.HTTPError, e:
+            self.assertEquals(e.code, 304)
+
+        request = urllib2.Request("http://localhost:27080/favicon.ico", headers={"Range": "bytes=-10"})
+        response = urllib2.urlopen(request)
+
+        self.assertEquals(response.getcode(), 206)
+        self.assertEquals(response.info().get('Content-Range'), "bytes %d-%d/%d" % (size - 10, size - 1, size))
+        self.assertEquals(len(response.read()), 10)
+
+    def test_metrics(self):
+        GET("http://localhost:27080/test/mongoose/_find")
+
+        s = GET("http://localhost:27080/_metrics")
+
+        self.assertTrue('sleepymongoose_request_duration_seconds_count{handler="_find",db="test",'
+                        'collection="mongoose",code="200"}' in s, s)
+        self.assertTrue('sleepymongoose_phase_duration_seconds_count{handler="_find",phase="mongo"}' in s, s)
+        self.assertTrue('sleepymongoose_requests_in_flight 1' in s, s)
+
+    def test_cursors(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_find",
+                {"batch_size": "2"})
+        _id = json.loads(s)['id']
+
+        s = GET("http://localhost:27080/_cursors")
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertTrue(_id in [c['id'] for c in obj['cursors']], s)
+
+        # The cursor is closed once it is exhausted, but _more still answers it
+        GET("http://localhost:27080/test/mongoose/_more", {"id": _id})
+
+        s = GET("http://localhost:27080/_cursors")
+        obj = json.loads(s)
+
+        self.assertFalse(_id in [c['id'] for c in obj['cursors']], s)
+
+        s = GET("http://localhost:27080/test/mongoose/_more", {"id": _id})
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(len(obj['results']), 0, s)
+
+    def test_aggregate(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_aggregate",
+                {"pipeline": '[{"$group" : {"_id" : "$x", "n" : {"$sum" : 1}}}, {"$sort" : {"_id" : 1}}]',
+                 "batch_size": "2", "allowDiskUse": "1"})
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(obj['results'], [{"_id": 1, "n": 1}, {"_id": 2, "n": 2}], s)
+
+        s = GET("http://localhost:27080/test/mongoose/_more", {"id": obj['id']})
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(obj['results'], [{"_id": 3, "n": 1}], s)
+
+    def test_aggregate_err(self):
+        s = GET("http://localhost:27080/test/mongoose/_aggregate",
+                {"pipeline": '[{"$nope" : {}}]'})
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 0, s)
+
+    def test_count(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_count",
+                {"criteria": '{"x" : {"$gt" : 1}}'})
+        obj = json.loads(s)
+
+        self.assertEquals(obj, {"ok": 1, "n": 3}, s)
+
+        s = GET("http://localhost:27080/test/mongoose/_count",
+                {"criteria": '{"x" : {"$gt" : 1}}', "skip": "1", "limit": "5"})
+        obj = json.loads(s)
+
+        self.assertEquals(obj['n'], 2, s)
+
+    def test_distinct(self):
+        POST("http://localhost:27080/test/mongoose/_insert",
+             params={'docs': '[{"x" : 1},{"x" : 2},{"x" : 2},{"x" : 3}]'},
+             async=False)
+
+        s = GET("http://localhost:27080/test/mongoose/_distinct",
+                {"key": "x", "criteria": '{"x" : {"$lt" : 3}}'})
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(sorted(obj['values']), [1, 2], s)
+        self.assertFalse('id' in obj, s)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@ from restclient import GET, POST
 
 import json
 import unittest
+import urllib2
 
 
 class TestPOST(unittest.TestCase):
@@ -85,6 +86,46 @@ class TestPOST(unittest.TestCase):
         self.assertEquals(obj['status']['ok'], 1)
         self.assertEquals(obj['status']['code'], 11000)
 
+    def test_insert_w0(self):
+        s = POST("http://localhost:27080/test/mongoose/_insert",
+                 params={'docs': '[{"foo" : "bar"}]', 'w': 0},
+                 async=False)
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(len(obj['oids']), 1, s)
+        self.assertFalse('err' in obj, s)
+
+    def test_write_concern_err(self):
+        s = POST("http://localhost:27080/test/mongoose/_remove",
+                 params={'criteria': '{}', 'wtimeout': 'soon'},
+                 async=False)
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 0, s)
+        self.assertEquals(obj['err'], 'invalid write concern')
+
+    def test_batch_insert_write_concern(self):
+        requests = [{"cmd": "_insert", "db": "test", "collection": "mongoose", "args": {"docs": [{"x": 1}]}},
+                    {"cmd": "_insert", "db": "test", "collection": "mongoose", "args": {"docs": [{"x": 2}]}},
+                    {"cmd": "_insert", "db": "test", "collection": "mongoose", "args": {"docs": [{"x": 3}], "w": 0}}]
+
+        s = POST("http://localhost:27080/_batch",
+                 params={"requests": json.dumps(requests)},
+                 async=False)
+
+        obj = json.loads(s)
+
+        # The same results as separate _inserts
+        self.assertEquals(len(obj), 3, s)
+        for result in obj:
+            self.assertEquals(result['ok'], 1, s)
+            self.assertEquals(len(result['oids']), 1, s)
+        self.assertEquals(obj[0]['err'], None, s)
+        self.assertFalse('err' in obj[2], s)
+
     def test_update_err1(self):
         s = POST("http://localhost:27080/_update",
                  async=False)
@@ -221,6 +262,97 @@ class TestPOST(unittest.TestCase):
         self.assertEquals(obj['ok'], 1, s)
         self.assertEquals(obj['n'], 1, s)
 
+    def test_bulk_write(self):
+        ops = [{"insertOne": {"document": {"_id": 1, "x": 1}}},
+               {"insertOne": {"document": {"_id": 2, "x": 1}}},
+               {"insertOne": {"document": {"_id": 1, "x": 2}}},
+               {"updateMany": {"filter": {"x": 1}, "update": {"$set": {"y": 1}}}},
+               {"replaceOne": {"filter": {"_id": 3}, "replacement": {"x": 3}, "upsert": True}},
+               {"deleteOne": {"filter": {"_id": 2}}}]
+
+        s = POST("http://localhost:27080/test/mongoose/_bulk_write",
+                 params={"ops": json.dumps(ops), "ordered": 0},
+                 async=False)
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(obj['nInserted'], 2, s)
+        self.assertEquals(obj['nMatched'], 2, s)
+        self.assertEquals(obj['nUpserted'], 1, s)
+        self.assertEquals(obj['nRemoved'], 1, s)
+        self.assertEquals(len(obj['writeErrors']), 1, s)
+        self.assertEquals(obj['writeErrors'][0]['index'], 2, s)
+
+    def test_bulk_write_ordered(self):
+        ops = [{"insertOne": {"document": {"_id": 1}}},
+               {"insertOne": {"document": {"_id": 1}}},
+               {"insertOne": {"document": {"_id": 2}}}]
+
+        s = POST("http://localhost:27080/test/mongoose/_bulk_write",
+                 params={"ops": json.dumps(ops)},
+                 async=False)
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(obj['nInserted'], 1, s)
+        self.assertEquals(obj['writeErrors'][0]['index'], 1, s)
+
+    def test_bulk_write_err(self):
+        s = POST("http://localhost:27080/test/mongoose/_bulk_write",
+                 params={"ops": '[{"dropAll": {}}]'},
+                 async=False)
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 0, s)
+
+    def test_import(self):
+        body = '{"_id": 1}\n{"_id": 2}\n\n{"_id": 1}\nnot json\n{"_id": 3}\n'
+        request = urllib2.Request("http://localhost:27080/test/mongoose/_import", body,
+                                  {"Content-Type": "application/x-ndjson"})
+        s = urllib2.urlopen(request).read()
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(obj['lines'], 6, s)
+        self.assertEquals(obj['nInserted'], 3, s)
+        self.assertEquals(obj['nErrors'], 2, s)
+        self.assertEquals([e['line'] for e in obj['errors']], [4, 5], s)
+        self.assertEquals(obj['progress'][-1]['nInserted'], 3, s)
+
+    def test_json_body(self):
+        request = urllib2.Request("http://localhost:27080/test/mongoose/_insert",
+                                  json.dumps({"docs": [{"x": 1}, {"x": 2}]}),
+                                  {"Content-Type": "application/json"})
+        s = urllib2.urlopen(request).read()
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+
+        # The body arguments take precedence over the query string
+        request = urllib2.Request("http://localhost:27080/test/mongoose/_find?criteria=%7B%7D",
+                                  json.dumps({"criteria": {"x": 2}, "fields": {"_id": 0}}),
+                                  {"Content-Type": "application/json; charset=utf-8"})
+        s = urllib2.urlopen(request).read()
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 1, s)
+        self.assertEquals(obj['results'], [{"x": 2}], s)
+
+    def test_json_body_err(self):
+        request = urllib2.Request("http://localhost:27080/test/mongoose/_insert", '[{"x": 1}]',
+                                  {"Content-Type": "application/json"})
+        s = urllib2.urlopen(request).read()
+
+        obj = json.loads(s)
+
+        self.assertEquals(obj['ok'], 0, s)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sleepymongoose.writebehind import WriteBehind
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.inserted = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def tearDown(self):
+        self.release.set()
+        self.buffer.close()
+
+    def _insert(self, key, docs):
+        self.release.wait()
+        if key == "fail":
+            raise Exception("couldn't insert")
+        self.inserted.append((key, list(docs)))
+        # Duplicates aren't inserted
+        return len([doc for doc in docs if doc != "dup"])
+
+    def _wait_for(self, n, timeout=2):
+        deadline = time.time() + timeout
+        while len(self.inserted) < n and time.time() < deadline:
+            time.sleep(0.005)
+
+    def test_flush_on_size(self):
+        self.buffer = WriteBehind(self._insert, max_docs=3, max_delay=10)
+
+        self.buffer.add("a", [1, 2])
+        time.sleep(0.05)
+        self.assertEquals(self.inserted, [])
+
+        self.buffer.add("a", [3])
+        self._wait_for(1)
+        self.assertEquals(self.inserted, [("a", [1, 2, 3])])
+
+    def test_flush_on_time(self):
+        self.buffer = WriteBehind(self._insert, max_docs=1000, max_delay=0.05)
+
+        start = time.time()
+        self.buffer.add("a", [1])
+        self.buffer.add("b", [2])
+        self._wait_for(2)
+
+        self.assertEquals(sorted(self.inserted), [("a", [1]), ("b", [2])])
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def test_backpressure(self):
+        self.buffer = WriteBehind(self._insert, max_docs=2, max_delay=0.01, max_buffered=4)
+        self.release.clear()
+
+        # Being inserted still counts until the insert is done
+        self.assertTrue(self.buffer.add("a", [1, 2]))
+        self.assertTrue(self.buffer.add("a", [3, 4]))
+        self.assertFalse(self.buffer.add("a", [5], timeout=0.05))
+
+        self.release.set()
+        self.assertTrue(self.buffer.add("a", [5], timeout=2))
+
+    def test_stats(self):
+        self.buffer = WriteBehind(self._insert, max_docs=2, max_delay=0.01)
+
+        self.buffer.add("a", [1, 2])
+        self.buffer.add("b", [3, "dup"])
+        self.buffer.add("fail", [4])
+        self.buffer.close()
+
+        stats = self.buffer.stats()
+        self.assertEquals(stats['buffered'], 0, stats)
+        self.assertEquals(stats['flushes'], 3, stats)
+        self.assertEquals(stats['flushed'], 3, stats)
+        self.assertEquals(stats['failures'], 2, stats)
+        self.assertEquals(stats['failed'], 2, stats)
+
+    def test_close(self):
+        self.buffer = WriteBehind(self._insert, max_docs=1000, max_delay=10)
+
+        self.buffer.add("a", [1, 2])
+        self.buffer.close()
+
+        self.assertEquals(self.inserted, [("a", [1, 2])])
+        self.assertFalse(self.buffer.add("a", [3]))
+
+
+if __name__ == '__main__':
+    unittest.main()